@@ -0,0 +1,183 @@
+import asyncio
+import random
+import re
+import time
+from aiohttp import web
+
+# Stand-ins for the Telegram Bot API and the Jira REST API used by the
+# benchmarks. Every response is delayed by `latency` seconds (± `jitter`
+# as a fraction of it), and `*_error_rate` of the requests fail with a 5xx.
+
+PHOTO_SIZE = 64 * 1024
+
+
+class FakeServices:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.5, telegram_error_rate: float = 0.0,
+                 jira_error_rate: float = 0.0, photo_size: int = PHOTO_SIZE, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.telegram_error_rate = telegram_error_rate
+        self.jira_error_rate = jira_error_rate
+        self.photo = b"\xff" * photo_size
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.errors = {}
+        self.issues = 0
+        self.attachments = 0
+        self.attachment_bytes = 0
+        self.statuses = {}
+        self.messages = []
+        self.updates = []
+        self.message_listeners = []
+        self._updates_changed = asyncio.Event()
+        self.runner = None
+        self.url = ""
+
+    def _app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.download_file)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_post("/rest/api/2/issue", self.create_issue)
+        app.router.add_post("/rest/api/2/issue/{key}/attachments", self.add_attachments)
+        app.router.add_post("/rest/api/2/search", self.search)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.runner = web.AppRunner(self._app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def _delay(self, endpoint: str) -> bool:
+        # Returns True when this request should fail.
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.latency:
+            spread = self.latency * self.jitter
+            await asyncio.sleep(max(0.0, self.random.uniform(self.latency - spread, self.latency + spread)))
+        rate = self.jira_error_rate if endpoint.startswith("jira.") else self.telegram_error_rate
+        if rate and self.random.random() < rate:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            return True
+        return False
+
+    # -----------------------------
+    # TELEGRAM
+    # -----------------------------
+
+    def push_update(self, update: dict):
+        self.updates.append(update)
+        self._updates_changed.set()
+
+    async def _params(self, request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    async def bot_api(self, request):
+        method = request.match_info["method"]
+        params = await self._params(request)
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if await self._delay("telegram." + method):
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error: injected"}, status=500
+            )
+        if method == "sendMessage":
+            return web.json_response({"ok": True, "result": self._message(params)})
+        if method == "getFile":
+            file_id = params["file_id"]
+            return web.json_response({"ok": True, "result": {
+                "file_id": file_id, "file_unique_id": f"u{file_id}",
+                "file_size": len(self.photo), "file_path": f"photos/{file_id}.jpg",
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        text = params.get("text", "")
+        self.messages.append((time.monotonic(), chat_id, text))
+        for listener in self.message_listeners:
+            listener(chat_id, text)
+        return {
+            "message_id": len(self.messages), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": text,
+        }
+
+    async def get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        while True:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if self.updates or time.monotonic() >= deadline:
+                return web.json_response({"ok": True, "result": self.updates[:100]})
+            self._updates_changed.clear()
+            try:
+                await asyncio.wait_for(self._updates_changed.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+
+    async def download_file(self, request):
+        if await self._delay("telegram.file"):
+            return web.Response(status=502)
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+    # -----------------------------
+    # JIRA
+    # -----------------------------
+
+    async def create_issue(self, request):
+        await request.read()
+        if await self._delay("jira.create_issue"):
+            return web.json_response({"errorMessages": ["injected"]}, status=503)
+        self.issues += 1
+        key = f"BENCH-{self.issues}"
+        self.statuses[key] = "To Do"
+        return web.json_response({"id": str(self.issues), "key": key, "self": f"{self.url}/rest/api/2/issue/{key}"},
+                                 status=201)
+
+    async def add_attachments(self, request):
+        reader = await request.multipart()
+        files = []
+        async for part in reader:
+            size = 0
+            while chunk := await part.read_chunk():
+                size += len(chunk)
+            self.attachment_bytes += size
+            files.append({"filename": part.filename, "size": size})
+        if await self._delay("jira.attachments"):
+            return web.json_response({"errorMessages": ["injected"]}, status=503)
+        self.attachments += len(files)
+        return web.json_response(files)
+
+    async def search(self, request):
+        # Understands the `key in (...)` part of the JQL; the rest is ignored.
+        body = await request.json()
+        if await self._delay("jira.search"):
+            return web.json_response({"errorMessages": ["injected"]}, status=503)
+        match = re.search(r"key in \(([^)]*)\)", body["jql"])
+        keys = [key.strip().strip('"') for key in match.group(1).split(",")] if match else list(self.statuses)
+        found = [key for key in keys if key in self.statuses]
+        start_at = body.get("startAt", 0)
+        page = found[start_at:start_at + body.get("maxResults", 50)]
+        return web.json_response({
+            "startAt": start_at, "maxResults": body.get("maxResults", 50), "total": len(found),
+            "issues": [{"key": key, "fields": {"status": {"name": self.statuses[key]}}} for key in page],
+        })
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "injected_errors": self.errors,
+            "issues": self.issues,
+            "attachments": self.attachments,
+            "attachment_bytes": self.attachment_bytes,
+            "messages": len(self.messages),
+        }
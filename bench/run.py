@@ -0,0 +1,374 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from fakes import FakeServices
+
+# Throughput benchmarks for the bot and the listener against local fake
+# Telegram and Jira servers. Prints one JSON document, so results can be
+# diffed between commits:
+#
+#   python bench/run.py --users 200 --webhooks 5000 --latency 0.02 > before.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:BENCHMARKbenchmarkBENCHMARKbenchmark"
+PASSWORD = "bench"
+SCENARIOS = ("bot", "listener")
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def latency_summary(values) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p99": percentile(values, 0.99),
+        "max": max(values, default=0.0),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fakes_from(args) -> FakeServices:
+    return FakeServices(
+        latency=args.latency, jitter=args.jitter, telegram_error_rate=args.telegram_error_rate,
+        jira_error_rate=args.jira_error_rate, seed=args.seed,
+    )
+
+# -----------------------------
+# BOT: synthetic users creating issues
+# -----------------------------
+
+def install_config(fake_url: str):
+    config = types.ModuleType("config")
+    config.API_TOKEN = BOT_TOKEN
+    config.TELEGRAM_API_SERVER = fake_url
+    config.JIRA_BASE_URL = fake_url
+    config.JIRA_API_URL = f"{fake_url}/rest/api/2/issue"
+    config.JIRA_API_TOKEN = "bench"
+    config.JIRA_PROJECT_KEY = "BENCH"
+    config.ACCESS_PASSWORD = PASSWORD
+    config.ADMIN_ID = []
+    config.BLOCKED_CHAT_ID = 0
+    sys.modules["config"] = config
+
+
+def user_updates(chat_id: int, photos: int, distinct_photos: int = 0, album: bool = False):
+    user = {"id": chat_id, "is_bot": False, "first_name": "Bench", "username": f"bench{chat_id}"}
+    chat = {"id": chat_id, "type": "private", "username": f"bench{chat_id}"}
+
+    def message(**content):
+        return {"message_id": 1, "date": int(time.time()), "chat": chat, "from": user, **content}
+
+    def callback(data):
+        return {"callback_query": {
+            "id": str(chat_id), "chat_instance": str(chat_id), "from": user, "data": data,
+            "message": message(text="…"),
+        }}
+
+    yield {"message": message(text="/start")}
+    yield {"message": message(text=PASSWORD)}
+    yield callback("create_task")
+    yield {"message": message(text=f"Benchmark issue from {chat_id}")}
+    yield {"message": message(text="Steps to reproduce: run the benchmark.")}
+    for i in range(photos):
+        # With distinct_photos users keep resending the same few screenshots.
+        file_id = f"photo-{(chat_id * photos + i) % distinct_photos}" if distinct_photos else f"photo-{chat_id}-{i}"
+        extra = {"media_group_id": f"album-{chat_id}"} if album else {}
+        yield {"message": message(photo=[{
+            "file_id": file_id, "file_unique_id": f"u{file_id}", "width": 1280, "height": 960,
+        }], **extra)}
+    yield callback("continue_after_photos")
+    yield callback("Средний")
+    yield {"message": message(text="Bench User, QA")}
+
+
+async def run_bot(args) -> dict:
+    fakes = fakes_from(args)
+    await fakes.start()
+    install_config(fakes.url)
+    sys.path.insert(0, os.path.join(ROOT, "bot"))
+    import bot as bot_app
+    import task_storage
+    from aiogram.types import Update
+
+    workdir = tempfile.mkdtemp(prefix="bench-bot-")
+    task_storage.DB_PATH = os.path.join(workdir, "bench.db")
+    await bot_app.start_services()
+    dp = bot_app.create_dispatcher()
+
+    submitted = {}
+    done = {}
+    all_done = asyncio.Event()
+
+    def on_message(chat_id, text):
+        if chat_id in submitted and chat_id not in done and ("создана" in text or "Не удалось создать" in text):
+            done[chat_id] = time.monotonic()
+            if len(done) == args.users:
+                all_done.set()
+
+    fakes.message_listeners.append(on_message)
+    update_latency = []
+    failed_updates = 0
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def user(index: int):
+        nonlocal failed_updates
+        chat_id = 100000 + index
+        for data in user_updates(chat_id, args.photos, args.distinct_photos, args.album):
+            data["update_id"] = next(update_ids)
+            if "message" in data and data["message"].get("text") == "Bench User, QA":
+                submitted[chat_id] = time.monotonic()
+            update = Update.model_validate(data, context={"bot": bot_app.bot})
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot_app.bot, update)
+            except Exception:
+                failed_updates += 1
+            update_latency.append(time.perf_counter() - started)
+
+    started = time.monotonic()
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with slots:
+            await user(index)
+
+    await asyncio.gather(*(limited(i) for i in range(args.users)))
+    try:
+        await asyncio.wait_for(all_done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.monotonic() - started
+
+    await bot_app.stop_services()
+    await bot_app.bot.session.close()
+    await fakes.close()
+
+    issue_latency = [done[chat_id] - submitted[chat_id] for chat_id in done]
+    return {
+        "users": args.users,
+        "photos_per_issue": args.photos,
+        "issues_completed": len(done),
+        "issues_per_second": len(done) / elapsed if elapsed else 0.0,
+        "elapsed": elapsed,
+        "failed_updates": failed_updates,
+        "update_latency": latency_summary(update_latency),
+        "issue_latency": latency_summary(issue_latency),
+        "photo_cache": bot_app.attachment_cache.stats(),
+        "fakes": fakes.stats(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+# -----------------------------
+# LISTENER: Jira webhook storm
+# -----------------------------
+
+def jira_events(count: int, issues: int):
+    statuses = ["To Do", "In Progress", "In Review", "Done"]
+    for i in range(count):
+        number = i % issues + 1
+        event = {
+            "timestamp": i,
+            "issue": {"key": f"BENCH-{number}", "fields": {"labels": [f"user_id:{100000 + number}"]}},
+        }
+        step = i // issues
+        if step % 3 == 2:
+            event["webhookEvent"] = "comment_created"
+            event["comment"] = {"id": str(i), "body": f"Comment {i}"}
+        else:
+            event["webhookEvent"] = "jira:issue_updated"
+            event["changelog"] = {"id": str(i), "items": [{
+                "field": "status",
+                "fromString": statuses[step % len(statuses)],
+                "toString": statuses[(step + 1) % len(statuses)],
+            }]}
+        yield event
+
+
+async def prepare_listener_db(path: str, issues: int):
+    import aiosqlite
+    import migrations
+
+    async with aiosqlite.connect(path) as db:
+        await migrations.migrate(db)
+        await db.executemany(
+            "INSERT INTO tasks (user_id, task_key, summary, state, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(100000 + n, f"BENCH-{n}", "Benchmark", "📝 К выполнению", int(time.time()))
+             for n in range(1, issues + 1)]
+        )
+        await db.commit()
+
+
+async def run_listener(args) -> dict:
+    import aiohttp
+    from aiohttp import web
+
+    fakes = fakes_from(args)
+    await fakes.start()
+    sys.path.insert(0, os.path.join(ROOT, "listener"))
+    sys.path.insert(1, os.path.join(ROOT, "bot"))
+    import listener
+    from telegram_sender import TokenBucket
+
+    workdir = tempfile.mkdtemp(prefix="bench-listener-")
+    db_path = os.path.join(workdir, "bench.db")
+    await prepare_listener_db(db_path, args.issues)
+    listener.DB_PATH = listener.status_writer.db_path = db_path
+    listener.telegram.url = f"{fakes.url}/bot{BOT_TOKEN}/sendMessage"
+    if args.telegram_rate:
+        listener.telegram.bucket = TokenBucket(args.telegram_rate, args.telegram_rate)
+
+    app = listener.create_app()
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}/jira-webhook"
+    events = app["events"]
+
+    ack_latency = []
+    rejected = 0
+    pending = iter(jira_events(args.webhooks, args.issues))
+
+    async def client(session):
+        nonlocal rejected
+        for event in pending:
+            started = time.perf_counter()
+            async with session.post(url, json=event) as response:
+                await response.read()
+                if response.status != 200:
+                    rejected += 1
+            ack_latency.append(time.perf_counter() - started)
+
+    started = time.monotonic()
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(client(session) for _ in range(args.concurrency)))
+    acked = time.monotonic() - started
+    await events.queue.join()
+    processed = time.monotonic() - started
+    stats = events.stats()
+
+    await runner.cleanup()
+    await fakes.close()
+
+    return {
+        "webhooks": args.webhooks,
+        "issues": args.issues,
+        "rejected": rejected,
+        "webhooks_per_second": stats["processed"] / processed if processed else 0.0,
+        "acks_per_second": args.webhooks / acked if acked else 0.0,
+        "elapsed": processed,
+        "ack_latency": latency_summary(ack_latency),
+        "queue": stats,
+        "telegram": listener.telegram.stats(),
+        "fakes": fakes.stats(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+# -----------------------------
+# MAIN
+# -----------------------------
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bot and listener throughput benchmarks.")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--users", type=int, default=100, help="synthetic users, one issue each")
+    parser.add_argument("--photos", type=int, default=2, help="photos attached to every issue")
+    parser.add_argument("--distinct-photos", type=int, default=0,
+                        help="draw photos from this many distinct images; 0 makes every photo unique")
+    parser.add_argument("--album", action="store_true", help="send each issue's photos as one album")
+    parser.add_argument("--webhooks", type=int, default=5000, help="Jira webhooks to send")
+    parser.add_argument("--issues", type=int, default=500, help="distinct issues the webhooks refer to")
+    parser.add_argument("--concurrency", type=int, default=50, help="users or HTTP clients running at once")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake server latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency jitter as a fraction of --latency")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--jira-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-rate", type=float, default=0.0,
+                        help="listener sendMessage rate; 0 keeps the production limit")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for issues to be created")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    return parser.parse_args(argv)
+
+
+def run_isolated(scenario: str, argv) -> dict:
+    # Each scenario gets its own process, so peak RSS is not shared.
+    args = [sys.executable, os.path.abspath(__file__), *argv, "--scenario", scenario]
+    result = subprocess.run(args, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1:] or ["exit code %d" % result.returncode]}
+    return json.loads(result.stdout)["results"][scenario]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.scenario == "all":
+        forwarded = _without_option(_without_option(argv, "--scenario"), "--output")
+        results = {scenario: run_isolated(scenario, forwarded) for scenario in SCENARIOS}
+    else:
+        # Handlers print progress; keep stdout for the JSON document.
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            runner = run_bot if args.scenario == "bot" else run_listener
+            results = {args.scenario: asyncio.run(runner(args))}
+        finally:
+            sys.stdout = stdout
+    document = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    text = json.dumps(document, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+def _without_option(argv, name):
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        if arg == name:
+            skip = True
+            continue
+        if arg.startswith(name + "="):
+            continue
+        result.append(arg)
+    return result
+
+
+if __name__ == "__main__":
+    main()
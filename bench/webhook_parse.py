@@ -0,0 +1,123 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from run import ROOT, git_revision, jira_events
+
+sys.path.insert(0, os.path.join(ROOT, "listener"))
+import events
+
+# Per-event CPU time and retained memory of webhook ingestion: the old path
+# (json.loads, keep the whole dict until a worker gets to it) against
+# events.parse_event. Payloads are padded the way Jira pads them, with user
+# objects, custom fields and rendered fields.
+#
+#   python bench/webhook_parse.py --events 2000 --custom-fields 150
+
+
+def user(n: int) -> dict:
+    return {
+        "self": f"https://jira.example.com/rest/api/2/user?accountId={n:024x}",
+        "accountId": f"{n:024x}",
+        "emailAddress": f"user{n}@example.com",
+        "avatarUrls": {size: f"https://avatar.example.com/{n}/{size}.png" for size in ("48x48", "24x24", "16x16", "32x32")},
+        "displayName": f"Пользователь {n}",
+        "active": True,
+        "timeZone": "Europe/Moscow",
+        "accountType": "atlassian",
+    }
+
+
+def pad(event: dict, custom_fields: int) -> dict:
+    number = int(event["issue"]["key"].split("-")[1])
+    fields = event["issue"]["fields"]
+    fields.update({
+        "summary": f"Задача {number}",
+        "description": "Описание задачи. " * 40,
+        "reporter": user(number),
+        "assignee": user(number + 1),
+        "creator": user(number),
+        "priority": {"id": "3", "name": "Medium", "iconUrl": "https://jira.example.com/images/icons/priorities/medium.svg"},
+        "issuetype": {"id": "10001", "name": "Task", "subtask": False, "description": "A small piece of work."},
+        "project": {"id": "10000", "key": "BENCH", "name": "Benchmark", "projectTypeKey": "software"},
+        "watches": {"watchCount": 2, "isWatching": False},
+        "created": "2024-05-01T12:00:00.000+0300",
+        "updated": "2024-05-02T12:00:00.000+0300",
+    })
+    for i in range(custom_fields):
+        fields[f"customfield_{10000 + i}"] = None if i % 3 else {"value": f"Option {i}", "id": str(20000 + i)}
+    event["issue"]["renderedFields"] = {"description": "<p>" + "Описание задачи. " * 40 + "</p>"}
+    event["user"] = user(number + 2)
+    return event
+
+
+def payloads(count: int, issues: int, custom_fields: int) -> list:
+    return [json.dumps(pad(event, custom_fields)).encode() for event in jira_events(count, issues)]
+
+
+def measure(parse, bodies: list, rounds: int) -> dict:
+    # CPU: best of several rounds over all bodies. Memory: everything the
+    # parsed objects keep alive while they wait in the queue.
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.process_time()
+        for body in bodies:
+            parse(body)
+        best = min(best, time.process_time() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    retained = [parse(body) for body in bodies]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del retained
+    return {
+        "cpu_us_per_event": best / len(bodies) * 1e6,
+        "retained_bytes_per_event": (current - baseline) / len(bodies),
+        "peak_mb": (peak - baseline) / 1024 / 1024,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Jira webhook parsing microbenchmark.")
+    parser.add_argument("--events", type=int, default=2000, help="webhook bodies to parse")
+    parser.add_argument("--issues", type=int, default=500, help="distinct issues the webhooks refer to")
+    parser.add_argument("--custom-fields", type=int, default=150, help="custom fields in every issue")
+    parser.add_argument("--rounds", type=int, default=5, help="CPU rounds, the best one is reported")
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bodies = payloads(args.events, args.issues, args.custom_fields)
+    old = measure(json.loads, bodies, args.rounds)
+    new = measure(events.parse_event, bodies, args.rounds)
+    document = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": {
+            "decoder": events.loads.__module__,
+            "avg_body_bytes": sum(map(len, bodies)) / len(bodies),
+            "json_dict": old,
+            "parse_event": new,
+            "cpu_speedup": old["cpu_us_per_event"] / new["cpu_us_per_event"] if new["cpu_us_per_event"] else 0.0,
+            "memory_ratio": (old["retained_bytes_per_event"] / new["retained_bytes_per_event"]
+                             if new["retained_bytes_per_event"] else 0.0),
+        },
+    }
+    text = json.dumps(document, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+ACCESS_CACHE_TTL = 60
+
+
+def _chat_id(value):
+    # users.chat_id is a TEXT column, block.chat_id an INTEGER one.
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class AccessCache:
+    # In-memory copy of the block list and registered users. Writes from this
+    # process update it directly; a full reload every `ttl` seconds picks up
+    # changes made by other processes.
+
+    def __init__(self, ttl: float = ACCESS_CACHE_TTL):
+        self.ttl = ttl
+        self.blocked_chat_ids = set()
+        self.blocked_usernames = set()
+        self.active_chat_ids = set()
+        self.user_ids = set()
+        # Lockouts not yet written to the block table; a reload keeps them.
+        self.unsaved = {}
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = asyncio.Lock()
+
+    def fresh(self) -> bool:
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    async def load(self, db):
+        async with db.execute("SELECT chat_id, username FROM block") as cursor:
+            blocked = await cursor.fetchall()
+        async with db.execute("SELECT id, chat_id FROM users") as cursor:
+            users = await cursor.fetchall()
+        self.blocked_chat_ids = {_chat_id(chat_id) for chat_id, _ in blocked}
+        self.blocked_usernames = {username for _, username in blocked if username}
+        self.active_chat_ids = {_chat_id(chat_id) for _, chat_id in users}
+        self.user_ids = {user_id for user_id, _ in users}
+        for chat_id, username in self.unsaved.items():
+            self.block(chat_id, username)
+        self.loaded_at = time.monotonic()
+
+    def block(self, chat_id, username):
+        self.blocked_chat_ids.add(_chat_id(chat_id))
+        if username:
+            self.blocked_usernames.add(username)
+
+    def block_unsaved(self, chat_id, username):
+        self.unsaved[_chat_id(chat_id)] = username
+        self.block(chat_id, username)
+
+    def saved(self, chat_ids):
+        for chat_id in chat_ids:
+            self.unsaved.pop(_chat_id(chat_id), None)
+
+    def unblock(self, username, chat_ids):
+        self.blocked_usernames.discard(username)
+        for chat_id in [chat_id for chat_id, name in self.unsaved.items() if name == username]:
+            del self.unsaved[chat_id]
+            self.blocked_chat_ids.discard(chat_id)
+        for chat_id in chat_ids:
+            self.blocked_chat_ids.discard(_chat_id(chat_id))
+
+    def add_user(self, user_id, chat_id):
+        self.user_ids.add(user_id)
+        self.active_chat_ids.add(_chat_id(chat_id))
+
+    def knows_user(self, user_id, chat_id) -> bool:
+        return user_id in self.user_ids and _chat_id(chat_id) in self.active_chat_ids
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "blocked": len(self.blocked_chat_ids),
+            "unsaved": len(self.unsaved),
+            "active": len(self.active_chat_ids),
+        }
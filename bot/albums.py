@@ -0,0 +1,60 @@
+import asyncio
+
+ALBUM_WINDOW = 0.8
+
+
+class AlbumCollector:
+    # Telegram delivers an album as one message per item, all sharing a
+    # media_group_id. Parts arriving within `window` seconds of the first one
+    # are collected and passed to `on_album(messages, state)` in a single
+    # call, in message order.
+
+    def __init__(self, on_album, window: float = ALBUM_WINDOW):
+        self.on_album = on_album
+        self.window = window
+        self.pending: dict = {}
+        self.timers: dict = {}
+        self.flushing: dict = {}
+        self.albums = 0
+        self.parts = 0
+
+    def add(self, message, state):
+        key = (message.chat.id, message.media_group_id)
+        album = self.pending.get(key)
+        if album is None:
+            album = self.pending[key] = ([], state)
+            self.timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush_later, key)
+        album[0].append(message)
+        self.parts += 1
+
+    def _flush_later(self, key):
+        task = asyncio.create_task(self.flush(key))
+        self.flushing[key] = task
+        task.add_done_callback(lambda done: self.flushing.pop(key, None))
+
+    async def flush(self, key):
+        album = self.pending.pop(key, None)
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if album is None:
+            return
+        messages, state = album
+        messages.sort(key=lambda message: message.message_id)
+        self.albums += 1
+        try:
+            await self.on_album(messages, state)
+        except Exception as e:
+            print(f"Ошибка при обработке альбома из {len(messages)} фото:", str(e))
+
+    async def flush_chat(self, chat_id):
+        # Called before anything else touches the chat's FSM data, so a
+        # buffered album is never lost or applied out of order.
+        keys = {key for key in (*self.pending, *self.flushing) if key[0] == chat_id}
+        await asyncio.gather(*(self.flushing.get(key) or self.flush(key) for key in keys))
+
+    async def close(self):
+        await asyncio.gather(*(self.flush(key) for key in list(self.pending)), *self.flushing.values())
+
+    def stats(self):
+        return {"pending": len(self.pending), "albums": self.albums, "parts": self.parts}
@@ -0,0 +1,97 @@
+import time
+from collections import OrderedDict, deque
+
+import task_storage
+from common import metrics
+from common.batching import WriteBehind
+
+MAX_AUTH_ATTEMPTS = 5
+AUTH_RATE_LIMIT = 3
+AUTH_RATE_WINDOW = 10
+AUTH_TRACKED_CHATS = 10000
+LOCKOUT_FLUSH_SIZE = 100
+LOCKOUT_FLUSH_INTERVAL = 1.0
+
+AUTH_ATTEMPTS = metrics.counter("bot_auth_attempts_total", "Password attempts, by outcome.", ("result",))
+LOCKOUTS_WRITTEN = metrics.counter("bot_lockouts_written_total", "Lockouts written to the block table.")
+
+
+class SlidingWindowLimiter:
+    # Allows at most `limit` attempts per chat in any `window` seconds. Runs
+    # before the attempt is counted in SQLite, so a flood of passwords from
+    # one chat costs a deque append per message instead of a write. Only the
+    # `max_chats` most recently seen chats are tracked.
+
+    def __init__(self, limit: int = AUTH_RATE_LIMIT, window: float = AUTH_RATE_WINDOW,
+                 max_chats: int = AUTH_TRACKED_CHATS):
+        self.limit = limit
+        self.window = window
+        self.max_chats = max_chats
+        self.attempts = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+
+    def allow(self, chat_id: int) -> bool:
+        now = time.monotonic()
+        attempts = self.attempts.get(chat_id)
+        if attempts is None:
+            attempts = self.attempts[chat_id] = deque()
+            while len(self.attempts) > self.max_chats:
+                self.attempts.popitem(last=False)
+        else:
+            self.attempts.move_to_end(chat_id)
+        while attempts and now - attempts[0] >= self.window:
+            attempts.popleft()
+        if len(attempts) >= self.limit:
+            self.rejected += 1
+            return False
+        attempts.append(now)
+        self.allowed += 1
+        return True
+
+    def retry_in(self, chat_id: int) -> float:
+        attempts = self.attempts.get(chat_id)
+        if not attempts:
+            return 0.0
+        return max(0.0, attempts[0] + self.window - time.monotonic())
+
+    def stats(self):
+        return {"tracked": len(self.attempts), "allowed": self.allowed, "rejected": self.rejected}
+
+
+class LockoutWriter(WriteBehind):
+    # Lockouts take effect at once through the access cache and are written
+    # to the block table in one transaction once LOCKOUT_FLUSH_SIZE are
+    # pending or LOCKOUT_FLUSH_INTERVAL seconds have passed since the first.
+
+    error_message = "Ошибка при сохранении блокировок:"
+
+    def __init__(self, flush_size: int = LOCKOUT_FLUSH_SIZE, flush_interval: float = LOCKOUT_FLUSH_INTERVAL):
+        super().__init__(flush_size, flush_interval)
+        self.lockouts = 0
+        self.rows_written = 0
+
+    def put(self, chat_id: int, reason: str, username: str):
+        task_storage.access.block_unsaved(chat_id, username)
+        if chat_id in self.pending:
+            return
+        self.add(chat_id, (chat_id, reason, username))
+        self.lockouts += 1
+
+    async def write(self, batch: dict, first_at: float):
+        # A lockout lifted by an admin before it was written is dropped.
+        rows = [row for chat_id, row in batch.items() if chat_id in task_storage.access.unsaved]
+        if not rows:
+            return
+        await task_storage.block_users(rows)
+        LOCKOUTS_WRITTEN.inc(len(rows))
+        self.rows_written += len(rows)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "lockouts": self.lockouts,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+        }
@@ -1,3 +1,7 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from aiogram import Bot, Router, types, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
@@ -5,16 +9,59 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
 from aiogram.fsm.state import StatesGroup, State
 from aiogram import Dispatcher
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 import task_storage
 import re
 import asyncio
 import config
 import aiohttp
 import json
-import certifi
-
-bot = Bot(token=config.API_TOKEN)
+import time
+import datetime
+from typing import AsyncIterator, NamedTuple
+from jira_client import JiraClient, JiraError, JiraUnavailable
+from outbox import OutboxDispatcher, OUTBOX_MAX_ATTEMPTS
+from fsm_storage import SQLiteStorage
+from albums import AlbumCollector
+from auth_limiter import LockoutWriter, SlidingWindowLimiter, MAX_AUTH_ATTEMPTS, AUTH_ATTEMPTS
+import photo_cache
+import reconciler
+import retention
+import webhook
+import telemetry
+from common import metrics
+
+BOT_MODE = getattr(config, "BOT_MODE", "polling")
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", "")
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", "")
+WEBHOOK_HOST = getattr(config, "WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8080)
+WEBHOOK_MAX_IN_FLIGHT = getattr(config, "WEBHOOK_MAX_IN_FLIGHT", webhook.WEBHOOK_MAX_IN_FLIGHT)
+METRICS_HOST = getattr(config, "METRICS_HOST", "0.0.0.0")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9100)
+metrics.TRACE_ENABLED = getattr(config, "TRACE_ENABLED", False)
+RECONCILE_INTERVAL = getattr(config, "RECONCILE_INTERVAL", reconciler.RECONCILE_INTERVAL)
+ARCHIVE_AFTER_DAYS = getattr(config, "ARCHIVE_AFTER_DAYS", retention.ARCHIVE_AFTER_DAYS)
+PHOTO_CACHE_DIR = getattr(config, "PHOTO_CACHE_DIR", photo_cache.PHOTO_CACHE_DIR)
+PHOTO_CACHE_MAX_BYTES = getattr(config, "PHOTO_CACHE_MAX_BYTES", photo_cache.PHOTO_CACHE_MAX_BYTES)
+
+TELEGRAM_API_SERVER = getattr(config, "TELEGRAM_API_SERVER", "")
+
+if TELEGRAM_API_SERVER:
+    bot = Bot(
+        token=config.API_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)),
+    )
+else:
+    bot = Bot(token=config.API_TOKEN)
+bot.session.middleware(telemetry.TelegramApiMiddleware())
+jira = JiraClient(config.JIRA_BASE_URL, config.JIRA_API_URL, config.JIRA_API_TOKEN)
 router = Router()
+auth_limiter = SlidingWindowLimiter()
+lockouts = LockoutWriter()
+telemetry.instrument_router(router)
 
 # -----------------------------
 # FSM STATES
@@ -36,28 +83,61 @@ class CreateIssue(StatesGroup):
 # -----------------------------
 # MAPS
 # -----------------------------
+ADMIN_IDS = frozenset(config.ADMIN_ID)
+
 SEVERITY_MAPPING = {
     "Высокий": "High",
     "Средний": "Medium",
     "Низкий": "Low"
 }
 
+# -----------------------------
+# ATTACHMENTS
+# -----------------------------
+ATTACH_CONCURRENCY = 4
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=120, sock_connect=10, sock_read=60)
+ATTACH_BATCH_MODE = True
+
+attachment_cache = photo_cache.PhotoCache(PHOTO_CACHE_DIR, PHOTO_CACHE_MAX_BYTES)
+
+class AttachResult(NamedTuple):
+    filename: str
+    ok: bool
+    error: str = ""
+    retryable: bool = False
+
+class AttachmentsPending(Exception):
+    # Some photos failed for reasons worth retrying. The outbox retries the
+    # item and only the photos not attached yet are uploaded again.
+    retryable = True
+
+TRANSIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, TelegramNetworkError, TelegramRetryAfter,
+                    TelegramServerError)
+
 # -----------------------------
 # UTILS
 # -----------------------------
 def escape_markdown(text: str) -> str:
-    return re.sub(r'([\\`_{}\[\]()#+\-.!|<>^&=])', r'\\\1', text)
+    return re.sub(r'([\\`_*~{}\[\]()#+\-.!|<>^&=])', r'\\\1', text)
+
+def is_transient_status(status) -> bool:
+    return status == 429 or status >= 500
+
+def is_transient_error(error: BaseException) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return is_transient_status(error.status)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+def format_created_at(created_at) -> str:
+    if not created_at:
+        return "—"
+    return datetime.datetime.fromtimestamp(created_at).strftime("%d %B %Y, %H:%M")
 
 # -----------------------------
 # JIRA INTEGRATION
 # -----------------------------
 
 async def create_jira_issue(summary, description, severity, user_id, project_key, issue_type="Task"):
-    headers = {
-        "Authorization": f"Bearer {config.JIRA_API_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
     payload = {
         "fields": {
             "project": {"key": project_key},
@@ -69,55 +149,175 @@ async def create_jira_issue(summary, description, severity, user_id, project_key
         }
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(config.JIRA_API_URL, headers=headers, json=payload) as response:
-            if response.status == 201:
-                data = await response.json()
-                issue_key = data["key"]
-                issue_url = f"{config.JIRA_BASE_URL}/browse/{issue_key}"
-                print("Задача создана:", issue_url)
-                return issue_url, issue_key
-            else:
-                text = await response.text()
-                print("Ошибка при создании задачи:", response.status)
-                print(text)
+    status, data = await jira.create_issue(payload)
+    if status == 201:
+        issue_key = data["key"]
+        issue_url = jira.browse_url(issue_key)
+        print("Задача создана:", issue_url)
+        return issue_url, issue_key
+    else:
+        print("Ошибка при создании задачи:", status)
+        print(data)
+        raise JiraError(status, data)
+
+async def attach_photos_to_issue(issue_key: str, photos: list[dict], on_attached=None) -> list[AttachResult]:
+    # on_attached(photo) is called as soon as a photo is attached, also when
+    # another upload then raises JiraUnavailable.
+    if not photos:
+        return []
+    started = time.perf_counter()
+    results = None
+    if ATTACH_BATCH_MODE and len(photos) > 1:
+        results = await upload_photos_batch(photos, issue_key)
+        if results is not None and on_attached is not None:
+            for photo, result in zip(photos, results):
+                if result.ok:
+                    on_attached(photo)
+    if results is None:
+        semaphore = asyncio.Semaphore(ATTACH_CONCURRENCY)
+
+        async def upload_limited(photo):
+            async with semaphore:
+                result = await upload_photo(photo, issue_key)
+            if result.ok and on_attached is not None:
+                on_attached(photo)
+            return result
+
+        # When one upload raises JiraUnavailable the others are cancelled
+        # and awaited, so none of them attaches a photo after the item has
+        # been put back with that photo still missing.
+        tasks = [asyncio.create_task(upload_limited(photo)) for photo in photos]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    failed = [r for r in results if not r.ok]
+    print(
+        f"Прикрепление фото к {issue_key}: {len(results) - len(failed)}/{len(results)} успешно "
+        f"за {time.perf_counter() - started:.2f} с"
+    )
+    for result in failed:
+        print(f"Ошибка при добавлении {result.filename}: {result.error}")
+    return list(results)
+
+class PhotoStream(NamedTuple):
+    filename: str
+    chunks: AsyncIterator[bytes]
+    response: aiohttp.ClientResponse | None = None
+
+    async def close(self):
+        await self.chunks.aclose()
+        if self.response is not None:
+            self.response.release()
+
+async def telegram_file_chunks(resp, cache_writer=None):
+    # With a cache_writer the download is copied to the photo cache while it
+    # streams to Jira, and kept only if it was read to the end.
+    size = resp.content_length or jira.stream_buffer_size
+    try:
+        async with jira.byte_budget.reserve(size):
+            async for chunk in resp.content.iter_chunked(jira.stream_buffer_size):
+                if cache_writer is not None:
+                    await cache_writer.write(chunk)
+                yield chunk
+        if cache_writer is not None:
+            await cache_writer.commit()
+    finally:
+        if cache_writer is not None:
+            cache_writer.discard()
+
+async def cached_file_chunks(path):
+    async with jira.byte_budget.reserve(os.path.getsize(path)):
+        with open(path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, jira.stream_buffer_size):
+                yield chunk
+
+async def open_photo_download(url):
+    # Downloaded through the bot's own session, so the Jira session's
+    # connection counters only see Jira.
+    session = await bot.session.create_session()
+    resp = await session.get(url, timeout=DOWNLOAD_TIMEOUT, read_bufsize=jira.stream_buffer_size)
+    if resp.status != 200:
+        resp.release()
+        raise aiohttp.ClientResponseError(
+            resp.request_info, resp.history, status=resp.status, message="не удалось скачать фото"
+        )
+    return resp
+
+async def open_photo(photo: dict) -> PhotoStream:
+    # The photo cache is checked before asking Telegram for a download link.
+    # Outbox items created before file_unique_id was stored only have a
+    # file_id, which getFile resolves.
+    file_unique_id = photo.get("file_unique_id")
+    path = await attachment_cache.lookup(file_unique_id) if file_unique_id else None
+    if path is None:
+        file_info = await bot.get_file(photo["file_id"])
+        if not file_unique_id:
+            file_unique_id = file_info.file_unique_id
+            path = await attachment_cache.lookup(file_unique_id)
+    filename = f"{file_unique_id}.jpg"
+    if path is not None:
+        return PhotoStream(filename, cached_file_chunks(path))
+    resp = await open_photo_download(bot.session.api.file_url(bot.token, file_info.file_path))
+    return PhotoStream(filename, telegram_file_chunks(resp, attachment_cache.writer(file_unique_id)), resp)
+
+def photo_label(photo: dict) -> str:
+    return photo.get("file_unique_id") or photo["file_id"]
+
+async def upload_photos_batch(photos, issue_key) -> list[AttachResult] | None:
+    # Downloads are opened concurrently, then streamed as "file" parts of
+    # one multipart request. Returns None when Jira rejects the batch so the
+    # caller can retry file by file and isolate the broken photo.
+    streams = await asyncio.gather(*(open_photo(photo) for photo in photos), return_exceptions=True)
+    results = [None] * len(photos)
+    files = []
+    uploaded = []
+    for i, (photo, stream) in enumerate(zip(photos, streams)):
+        if isinstance(stream, BaseException):
+            results[i] = AttachResult(photo_label(photo), False, str(stream), is_transient_error(stream))
+        else:
+            files.append((stream.filename, stream.chunks))
+            uploaded.append(i)
+    try:
+        if files:
+            status, response = await jira.upload_attachments(issue_key, files)
+            if status != 200:
+                print(f"Пакетная загрузка фото к {issue_key} не удалась: {status}, ответ от Jira: {response}")
                 return None
-
-async def attach_photos_to_issue(issue_key: str, photo_urls: list[str]):
-    headers = {
-        "Authorization": f"Bearer {config.JIRA_API_TOKEN}",
-        "X-Atlassian-Token": "no-check"
-    }
-
-    upload_url = f"{config.JIRA_BASE_URL}/rest/api/2/issue/{issue_key}/attachments"
-    
-    async with aiohttp.ClientSession() as session:
-        for url in photo_urls:
-            print(f"Попытка прикрепить фото с URL: {url}")
-            await upload_photo(url, session, upload_url, headers)
-
-async def upload_photo(url, session, upload_url, headers):
+            for i in uploaded:
+                results[i] = AttachResult(streams[i].filename, True)
+    except JiraUnavailable:
+        raise
+    except Exception as e:
+        print(f"Пакетная загрузка фото к {issue_key} не удалась: {str(e)}")
+        return None
+    finally:
+        for stream in streams:
+            if not isinstance(stream, BaseException):
+                await stream.close()
+    return results
+
+async def upload_photo(photo, issue_key) -> AttachResult:
+    filename = photo_label(photo)
     try:
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                photo_data = await resp.read()
-                filename = url.split("/")[-1]
-
-                form = aiohttp.FormData()
-                form.add_field("file", photo_data, filename=filename)
-
-                async with session.post(upload_url, headers=headers, data=form) as attach_resp:
-                    response_text = await attach_resp.text()
-                    if attach_resp.status != 200:
-                        print(f"Ошибка при добавлении {filename}: {attach_resp.status}")
-                        print(f"Ответ от Jira: {response_text}")
-                    else:
-                        print(f"✅ Успешно прикреплён файл: {filename}")
-                        print(f"Ответ от Jira: {response_text}")
-            else:
-                print(f"Не удалось скачать фото: {url}, статус: {resp.status}")
+        stream = await open_photo(photo)
+        filename = stream.filename
+        try:
+            status, response_text = await jira.upload_attachment(issue_key, stream.filename, stream.chunks)
+        finally:
+            await stream.close()
+        if status != 200:
+            return AttachResult(
+                filename, False, f"{status}, ответ от Jira: {response_text}", is_transient_status(status)
+            )
+        return AttachResult(filename, True)
+    except JiraUnavailable:
+        raise
     except Exception as e:
-        print(f"Ошибка при обработке фото {url}: {str(e)}")
+        return AttachResult(filename, False, str(e), is_transient_error(e))
 
 # -----------------------------
 # KEYBOARDS
@@ -173,7 +373,7 @@ async def start(message: types.Message, state: FSMContext):
 
     if await task_storage.in_active(chat_id):
         await task_storage.add_user(message)
-        is_admin = chat_id in config.ADMIN_ID
+        is_admin = chat_id in ADMIN_IDS
         if is_admin:
             await message.answer("Привет! Выберите действие:", reply_markup=get_inline_start_keyboard(is_admin=True))
             return
@@ -189,25 +389,37 @@ async def process_password(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     username = message.chat.username
     password = message.text.strip()
-    attempts = await task_storage.get_auth_attempts(chat_id)
 
-    if attempts >= 5:
-        await task_storage.block_user(chat_id, "Превышено число попыток авторизации", username)
-        await state.clear()
-        await message.answer("🚫 Вы ввели неправильный пароль 5 раз. Доступ заблокирован.")
+    # Messages already queued when the chat was locked out.
+    if await task_storage.in_block(chat_id):
+        AUTH_ATTEMPTS.inc(result="blocked")
+        return
+    if not auth_limiter.allow(chat_id):
+        AUTH_ATTEMPTS.inc(result="limited")
+        await message.answer(
+            f"⏳ Слишком много попыток. Повторите через {int(auth_limiter.retry_in(chat_id)) + 1} с."
+        )
         return
     if password == config.ACCESS_PASSWORD:
+        AUTH_ATTEMPTS.inc(result="ok")
         await task_storage.add_user(message)
         await task_storage.clear_auth_attempts(chat_id)
         await state.clear()
         await message.answer("✅ Доступ разрешён. Добро пожаловать!")
         await start(message, state)
-    else:
-        await task_storage.increment_auth_attempts(chat_id, username)
-        remaining = 5 - (attempts + 1)
-        await message.answer(
-            f"❌ Неверный пароль. Осталось попыток: {remaining}"
-        )
+        return
+
+    attempts = await task_storage.increment_auth_attempts(chat_id, username)
+    if attempts >= MAX_AUTH_ATTEMPTS:
+        AUTH_ATTEMPTS.inc(result="locked")
+        lockouts.put(chat_id, "Превышено число попыток авторизации", username)
+        await state.clear()
+        await message.answer(f"🚫 Вы ввели неправильный пароль {MAX_AUTH_ATTEMPTS} раз. Доступ заблокирован.")
+        return
+    AUTH_ATTEMPTS.inc(result="wrong")
+    await message.answer(
+        f"❌ Неверный пароль. Осталось попыток: {MAX_AUTH_ATTEMPTS - attempts}"
+    )
 
 # -----------------------------
 # TASK HANDLERS
@@ -242,17 +454,33 @@ async def process_description(message: types.Message, state: FSMContext):
         reply_markup=get_continue_inline_keyboard()
     )
 
-@router.message(CreateIssue.waiting_for_photos, F.content_type == types.ContentType.PHOTO)
-async def process_photos(message: types.Message, state: FSMContext):
+async def add_photos(state: FSMContext, messages):
     user_data = await state.get_data()
     photos = user_data.get("photos", [])
 
-    file_id = message.photo[-1].file_id
-    file_info = await bot.get_file(file_id)
-    file_url = f"https://api.telegram.org/file/bot{config.API_TOKEN}/{file_info.file_path}"
-
-    photos.append(file_url)
+    # Only the ids are kept; the download URL is resolved when the outbox
+    # uploads the photo, since Telegram file links expire, and not at all
+    # when the photo cache already has it.
+    for message in messages:
+        photo = message.photo[-1]
+        photos.append({"file_id": photo.file_id, "file_unique_id": photo.file_unique_id})
     await state.update_data(photos=photos)
+
+async def process_album(messages, state: FSMContext):
+    await add_photos(state, messages)
+    await messages[0].answer(f"Добавлено фото: {len(messages)}. Можете прикрепить ещё или нажмите 'Продолжить'.",
+        reply_markup=get_continue_inline_keyboard()
+    )
+
+albums = AlbumCollector(process_album)
+
+@router.message(CreateIssue.waiting_for_photos, F.content_type == types.ContentType.PHOTO)
+async def process_photos(message: types.Message, state: FSMContext):
+    if message.media_group_id:
+        albums.add(message, state)
+        return
+    await albums.flush_chat(message.chat.id)
+    await add_photos(state, [message])
     await message.answer("Фото добавлено. Можете прикрепить ещё или нажмите 'Продолжить'.",
         reply_markup=get_continue_inline_keyboard()
     )
@@ -260,6 +488,7 @@ async def process_photos(message: types.Message, state: FSMContext):
 
 @router.callback_query(F.data == "continue_after_photos")
 async def handle_continue_after_photos(callback: types.CallbackQuery, state: FSMContext):
+    await albums.flush_chat(callback.message.chat.id)
     await state.set_state(CreateIssue.waiting_for_severity)
     await callback.message.answer("Теперь выберите уровень важности:", reply_markup=get_inline_severity_keyboard())
     await callback.answer()
@@ -278,7 +507,6 @@ async def process_severity(callback: types.CallbackQuery, state: FSMContext):
 async def process_author_info(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     author_info = message.text.strip()
-    await state.update_data(author_info=author_info)
 
     title = user_data["title"]
     description = user_data["description"]
@@ -286,58 +514,231 @@ async def process_author_info(message: types.Message, state: FSMContext):
     issue_type = user_data["issue_type"]
     photos = user_data.get("photos", [])
 
+    await task_storage.enqueue_issue(
+        message.from_user.id,
+        message.chat.id,
+        {
+            "title": title,
+            "description": description,
+            "severity": severity,
+            "issue_type": issue_type,
+            "author_info": author_info,
+            "photos": photos,
+            "correlation_id": metrics.correlation_id.get(),
+        }
+    )
+    outbox.notify()
+    await message.answer(
+        "⏳ Заявка принята. Мы создадим задачу в Jira и пришлём сообщение, когда всё будет готово."
+    )
+
+    await state.clear()
+    await start(message, state)
+
+# -----------------------------
+# OUTBOX DELIVERY
+# -----------------------------
+
+async def deliver_issue(item):
+    data = item.payload
+    metrics.set_correlation_id(data.get("correlation_id") or f"outbox-{item.id}")
+    with metrics.span("outbox.deliver", item=item.id, attempt=item.attempts):
+        await _deliver_issue(item, data)
+
+async def _deliver_issue(item, data):
+    title = data["title"]
+    description = data["description"]
+    severity = data["severity"]
+    issue_type = data["issue_type"]
+    author_info = data["author_info"]
+    # Items queued before file_unique_id was stored hold bare file_ids.
+    photos = [photo if isinstance(photo, dict) else {"file_id": photo} for photo in data.get("photos", [])]
+
     safe_title = escape_markdown(title)
     safe_description = escape_markdown(description)
     safe_severity = escape_markdown(severity)
     safe_author = escape_markdown(author_info)
 
-    issue_url, issue_key = await create_jira_issue(
-        summary=title,
-        description=f"{description}\n\n*Автор:* {author_info}\n*Уровень важности:* {severity}",
-        severity=SEVERITY_MAPPING.get(severity, "Medium"),
-        user_id=message.from_user.id,
-        project_key=config.JIRA_PROJECT_KEY,
-        issue_type=issue_type
-    )
+    issue_key = item.task_key
+    if not issue_key:
+        issue_url, issue_key = await create_jira_issue(
+            summary=title,
+            description=f"{description}\n\n*Автор:* {author_info}\n*Уровень важности:* {severity}",
+            severity=SEVERITY_MAPPING.get(severity, "Medium"),
+            user_id=item.user_id,
+            project_key=config.JIRA_PROJECT_KEY,
+            issue_type=issue_type
+        )
+        await task_storage.set_outbox_task_key(item.id, issue_key)
+
+    # Photos attached by earlier attempts are not uploaded again. Transient
+    # failures are retried through the outbox until its last attempt; only
+    # what still failed then is reported to the user.
+    done = set(item.attached_photos)
+    if photos and not item.attached:
+        missing = [photo for photo in photos if photo_label(photo) not in done]
+        final = False
+        try:
+            attach_results = await attach_photos_to_issue(
+                issue_key, missing, on_attached=lambda photo: done.add(photo_label(photo))
+            )
+            final = item.attempts >= OUTBOX_MAX_ATTEMPTS or not any(
+                not result.ok and result.retryable for result in attach_results
+            )
+        finally:
+            await task_storage.set_outbox_attached_photos(item.id, sorted(done), final)
+        if not final:
+            raise AttachmentsPending(f"не прикреплено фото: {len(photos) - len(done)}")
+    attached = sum(1 for photo in photos if photo_label(photo) in done)
+    failed = len(photos) - attached
+
+    failed_line = f"*Не удалось прикрепить фото: {failed}*\n" if failed else ""
+    await task_storage.complete_outbox_issue(item.id, item.user_id, issue_key, safe_title, "К выполнению")
+    # The issue is saved; a failed confirmation must not make the outbox
+    # deliver it again or report it as not created.
+    kind = 'Задача' if issue_type == 'Task' else 'Ошибка'
+    try:
+        try:
+            await bot.send_message(
+                item.chat_id,
+                f"✅ {kind} {escape_markdown(issue_key)} создана\!\n\n"
+                f"*Название:* {safe_title}\n"
+                f"*Описание:* {safe_description}\n"
+                f"*Автор:* {safe_author}\n"
+                f"*Уровень важности:* {safe_severity}\n"
+                f"{f'*Прикреплено фото: {attached}*' if attached else ''}\n"
+                f"{failed_line}"
+                f"Все созданные задачи можно посмотреть в разделе 'Мои задачи'",
+                parse_mode="MarkdownV2"
+            )
+        except TelegramBadRequest as e:
+            print(f"Подтверждение по {issue_key} не прошло разметку: {str(e)}")
+            await bot.send_message(
+                item.chat_id,
+                "\n".join(filter(None, (
+                    f"✅ {kind} {issue_key} создана: {title}",
+                    f"Прикреплено фото: {attached}" if attached else "",
+                    f"Не удалось прикрепить фото: {failed}" if failed else "",
+                    "Все созданные задачи можно посмотреть в разделе 'Мои задачи'",
+                ))),
+                parse_mode=None
+            )
+    except Exception as e:
+        print(f"Не удалось отправить подтверждение по {issue_key}:", str(e))
 
+async def report_issue_failure(item, error):
+    # The attempt that failed may have created the issue already.
+    issue_key = item.task_key or await task_storage.get_outbox_task_key(item.id)
     if issue_key:
-        await attach_photos_to_issue(issue_key, photos)
-        issue_url = f"{config.JIRA_BASE_URL}/browse/{issue_key}"
-        await task_storage.save_task(message.from_user.id, issue_key, safe_title, "К выполнению")
-        await message.answer(
-            f"✅ { 'Задача' if issue_type == 'Task' else 'Ошибка' } создана\!\n\n"
-            f"*Название:* {safe_title}\n"
-            f"*Описание:* {safe_description}\n"
-            f"*Автор:* {safe_author}\n"
-            f"*Уровень важности:* {safe_severity}\n"
-            f"{f'*Прикреплено фото: {len(photos)}*' if photos else ''}\n"
-            f"Все созданные задачи можно посмотреть в разделе 'Мои задачи'",
-            parse_mode="MarkdownV2"
+        print(f"Заявка {item.id}: задача {issue_key} создана, но не сохранена: {error}")
+        return
+    await bot.send_message(
+        item.chat_id,
+        f"❌ Не удалось создать задачу «{item.payload['title']}». Попробуйте ещё раз позже."
+    )
+
+outbox = OutboxDispatcher(deliver_issue, report_issue_failure, gate=jira.governor.retry_in)
+status_reconciler = reconciler.StatusReconciler(jira, RECONCILE_INTERVAL)
+task_archiver = retention.TaskArchiver(ARCHIVE_AFTER_DAYS)
+
+TASK_FILTERS = {
+    # name: (title, finished, archived)
+    "all": ("Все", None, False),
+    "open": ("Активные", False, False),
+    "done": ("Завершённые", True, False),
+    "archive": ("📦 Архив", None, True),
+}
+
+def get_tasks_keyboard(task_filter, newer_id=None, older_id=None):
+    nav = []
+    if newer_id is not None:
+        nav.append(InlineKeyboardButton(text="◀️ Новее", callback_data=f"tasks:{task_filter}:a:{newer_id}"))
+    if older_id is not None:
+        nav.append(InlineKeyboardButton(text="Старше ▶️", callback_data=f"tasks:{task_filter}:b:{older_id}"))
+    filters = [
+        InlineKeyboardButton(
+            text=f"{'• ' if name == task_filter else ''}{title}", callback_data=f"tasks:{name}:b:0"
+        )
+        for name, (title, _, _) in TASK_FILTERS.items()
+    ]
+    buttons = [nav, filters] if nav else [filters]
+    return InlineKeyboardMarkup(inline_keyboard=buttons + get_inline_start_keyboard().inline_keyboard)
+
+MESSAGE_LIMIT = 4096
+
+def render_tasks_page(rows):
+    # Summaries are stored already escaped by _deliver_issue. Returns the
+    # text and how many rows fit into one Telegram message.
+    text = ""
+    for count, (_, task_key, summary, state, created_at) in enumerate(rows):
+        entry = (
+            f"*{escape_markdown(task_key)}*\n"
+            f"📌 _{summary}_\n"
+            f"📅 {escape_markdown(format_created_at(created_at))} | 🏷️ *{escape_markdown(state or '')}*\n\n"
         )
+        if count and len(text) + len(entry) > MESSAGE_LIMIT:
+            return text, count
+        text += entry
+    return text, len(rows)
+
+async def show_tasks_page(callback: types.CallbackQuery, task_filter="all", direction="b", cursor=0, edit=False):
+    user_id = callback.from_user.id
+    _, finished, archived = TASK_FILTERS[task_filter]
+    # One row more than a page is fetched to learn whether there is another
+    # page in the direction of travel; the cursor row lies the other way.
+    limit = task_storage.TASKS_PAGE_SIZE
+    if direction == "a":
+        rows = await task_storage.get_tasks_page(
+            user_id, after_id=cursor, limit=limit + 1, finished=finished, archived=archived
+        )
+        has_newer, has_older = len(rows) > limit, True
+        rows = rows[-limit:]
     else:
-        await message.answer("Не удалось создать задачу.")
-        return
+        rows = await task_storage.get_tasks_page(
+            user_id, before_id=cursor or None, limit=limit + 1, finished=finished, archived=archived
+        )
+        has_newer, has_older = bool(cursor), len(rows) > limit
+        rows = rows[:limit]
 
-    await state.clear()
-    await start(message, state)
+    if not rows:
+        text = "У вас пока нет задач 📭" if task_filter == "all" else "В этом разделе задач нет 📭"
+        keyboard = get_tasks_keyboard(task_filter)
+        parse_mode = None
+    else:
+        text, shown = render_tasks_page(rows)
+        # Rows that did not fit are older than the ones shown.
+        has_older = has_older or shown < len(rows)
+        rows = rows[:shown]
+        newest_id, oldest_id = rows[0][0], rows[-1][0]
+        keyboard = get_tasks_keyboard(
+            task_filter,
+            newer_id=newest_id if has_newer else None,
+            older_id=oldest_id if has_older else None,
+        )
+        parse_mode = "MarkdownV2"
+
+    if edit:
+        try:
+            await callback.message.edit_text(text, parse_mode=parse_mode, reply_markup=keyboard)
+        except TelegramBadRequest as e:
+            # Pressing the filter that is already shown leaves the message unchanged.
+            if "message is not modified" not in e.message:
+                raise
+    else:
+        await callback.message.answer(text, parse_mode=parse_mode, reply_markup=keyboard)
 
 @router.callback_query(F.data == "my_tasks")
 async def handle_my_tasks(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    tasks = await task_storage.get_tasks_for_user(user_id)
-    if not tasks:
-        await callback.message.answer("У вас пока нет задач 📭")
-        reply_markup=get_inline_start_keyboard()
-    else:
-        text = ""
-        for i, (task_key, summary, state, created_at) in enumerate(tasks, start=1):    
-            text += (
-                f"*{i}*. *{task_key}*\n"
-                f"📌 _{summary}_\n"
-                f"📅 {created_at} | 🏷️ *{state}*\n\n"
-            )    
-        await callback.message.answer(escape_markdown(text), parse_mode="MarkdownV2", reply_markup=get_inline_start_keyboard())
-    await callback.answer()  
+    await show_tasks_page(callback)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("tasks:"))
+async def handle_tasks_page(callback: types.CallbackQuery):
+    _, task_filter, direction, cursor = callback.data.split(":")
+    if task_filter not in TASK_FILTERS:
+        task_filter = "all"
+    await show_tasks_page(callback, task_filter, direction, int(cursor), edit=True)
+    await callback.answer()
 
 # -----------------------------
 # UNBLOCK HANDLERS
@@ -345,7 +746,7 @@ async def handle_my_tasks(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "unblock_user")
 async def handle_unblock_user(callback: types.CallbackQuery, state: FSMContext):
-    if callback.from_user.id in config.ADMIN_ID:
+    if callback.from_user.id in ADMIN_IDS:
         await callback.message.answer("Введите username пользователя без символа @ для разблокировки:", 
             parse_mode="Markdown")
         await callback.answer()
@@ -358,7 +759,7 @@ async def handle_unblock_user(callback: types.CallbackQuery, state: FSMContext):
 async def process_unblock_username(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
 
-    if user_id not in config.ADMIN_ID:
+    if user_id not in ADMIN_IDS:
         await start(message, state)
 
     username = message.text.strip()
@@ -380,13 +781,67 @@ async def process_unblock_username(message: types.Message, state: FSMContext):
 # MAIN ENTRY
 # -----------------------------
 
-async def main():
-    await task_storage.init_db()
-    dp = Dispatcher()
+def create_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=SQLiteStorage())
+    dp.update.outer_middleware(telemetry.UpdateTraceMiddleware())
     dp.include_router(router)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    return dp
+
+async def start_services():
+    await task_storage.init_db()
+    await jira.start()
+    attachment_cache.open()
+    outbox.start()
+    lockouts.start()
+    if RECONCILE_INTERVAL:
+        status_reconciler.start()
+    task_archiver.start()
+
+async def stop_services():
+    await albums.close()
+    await status_reconciler.close()
+    await task_archiver.close()
+    await outbox.close()
+    await lockouts.close()
+    print("Авторизация:", {**auth_limiter.stats(), **lockouts.stats()})
+    print("Кэш доступа:", task_storage.access.stats())
+    print("Статистика Jira:", jira.stats.as_dict())
+    print("Состояние Jira:", jira.governor.stats())
+    print("Кэш фото:", attachment_cache.stats())
+    print("Архивация задач:", task_archiver.stats())
+    await jira.close()
+    await task_storage.close_pool()
+
+async def main():
+    await start_services()
+    dp = create_dispatcher()
+    try:
+        if BOT_MODE == "webhook":
+            await webhook.serve(
+                dp, bot, WEBHOOK_HOST, WEBHOOK_PORT,
+                url=WEBHOOK_URL, secret=WEBHOOK_SECRET, max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+            )
+        else:
+            metrics_runner = await telemetry.serve_metrics(METRICS_HOST, METRICS_PORT)
+            try:
+                await bot.delete_webhook(drop_pending_updates=False)
+                await dp.start_polling(bot)
+            finally:
+                await metrics_runner.cleanup()
+    finally:
+        await stop_services()
+
+async def run_worker(port: int, secret: str):
+    # Worker process started by supervisor.py: updates for its share of the
+    # chats are forwarded to a local webhook endpoint.
+    await start_services()
+    dp = create_dispatcher()
+    try:
+        await webhook.serve(
+            dp, bot, "127.0.0.1", port, secret=secret, max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+        )
+    finally:
+        await stop_services()
 
 if __name__ == "__main__":
     asyncio.run(main())
-
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import task_storage
+
+FSM_STATE_TTL = 24 * 60 * 60
+FSM_CACHE_SIZE = 1024
+FSM_CACHE_TTL = 30
+FSM_SWEEP_INTERVAL = 10 * 60
+
+
+def _dump(data: Dict[str, Any]) -> Optional[str]:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None
+
+
+class SQLiteStorage(BaseStorage):
+    # FSM state shared through the bot's SQLite database, so that several bot
+    # processes see the same conversations and a restart keeps them.
+    # Recently used keys are kept in a small LRU of serialized rows; an entry
+    # is trusted for FSM_CACHE_TTL seconds, since updates for one chat are
+    # routed to one process at a time. Conversations untouched for
+    # FSM_STATE_TTL seconds are treated as abandoned and deleted.
+
+    def __init__(self, state_ttl: int = FSM_STATE_TTL, cache_size: int = FSM_CACHE_SIZE,
+                 cache_ttl: float = FSM_CACHE_TTL):
+        self.state_ttl = state_ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.last_sweep = time.monotonic()
+        self._sweeping = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny,
+        ))
+
+    def _remember(self, key: str, state: Optional[str], data: Optional[str]):
+        self.cache[key] = (state, data, time.monotonic())
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def _load(self, key: str):
+        cached = self.cache.get(key)
+        if cached is not None and time.monotonic() - cached[2] < self.cache_ttl:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return cached[0], cached[1]
+        self.misses += 1
+        state, data = await task_storage.get_fsm_state(key, int(time.time()) - self.state_ttl)
+        self._remember(key, state, data)
+        return state, data
+
+    async def _store(self, key: str, column: str, value: Optional[str]):
+        await task_storage.set_fsm_field(key, column, value)
+        self._maybe_sweep()
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self.last_sweep < FSM_SWEEP_INTERVAL or self._sweeping is not None:
+            return
+        self.last_sweep = time.monotonic()
+        self._sweeping = asyncio.create_task(self.sweep())
+
+    async def sweep(self):
+        try:
+            await task_storage.delete_fsm_states_before(int(time.time()) - self.state_ttl)
+        except Exception as e:
+            print("Ошибка при очистке устаревших состояний FSM:", str(e))
+        finally:
+            self._sweeping = None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key = self._key(key)
+        state = state.state if isinstance(state, State) else state
+        _, data = await self._load(key)
+        await self._store(key, "state", state)
+        self._remember(key, state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        key = self._key(key)
+        data = _dump(data)
+        state, _ = await self._load(key)
+        await self._store(key, "data", data)
+        self._remember(key, state, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return json.loads(data) if data else {}
+
+    async def close(self) -> None:
+        if self._sweeping is not None:
+            await self._sweeping
+
+    def stats(self):
+        return {"cached": len(self.cache), "hits": self.hits, "misses": self.misses}
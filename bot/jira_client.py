@@ -0,0 +1,444 @@
+import aiohttp
+import asyncio
+import certifi
+import email.utils
+import ssl
+import time
+from contextlib import asynccontextmanager
+from common import metrics
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+TOTAL_TIMEOUT = 120
+CONNECTION_LIMIT = 100
+CONNECTIONS_PER_HOST = 20
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+STREAM_BUFFER_SIZE = 64 * 1024
+ATTACHMENT_BYTES_BUDGET = 32 * 1024 * 1024
+GOVERNOR_MIN_LIMIT = 1
+GOVERNOR_INITIAL_LIMIT = 8
+LATENCY_TARGET = 3.0
+LIMIT_DECREASE_FACTOR = 0.5
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30
+BREAKER_MAX_COOLDOWN = 300
+RETRY_AFTER_MAX = 300
+
+REQUEST_SECONDS = metrics.histogram(
+    "jira_request_seconds", "Latency of Jira REST calls.", ("endpoint",)
+)
+REQUESTS_TOTAL = metrics.counter(
+    "jira_requests_total", "Jira REST calls by response status.", ("endpoint", "status")
+)
+IN_FLIGHT = metrics.gauge("jira_requests_in_flight", "Jira REST calls awaiting a response.", ("endpoint",))
+CONCURRENCY_LIMIT = metrics.gauge("jira_concurrency_limit", "Current adaptive limit on concurrent Jira calls.")
+BREAKER_STATE = metrics.gauge("jira_breaker_state", "Jira circuit breaker: 0 closed, 1 half-open, 2 open.")
+BREAKER_TRIPS = metrics.counter("jira_breaker_trips_total", "Times the Jira circuit breaker opened.")
+CONNECTIONS = metrics.counter(
+    "jira_connections_total", "Connections to Jira, by whether a pooled one was reused.", ("result",)
+)
+REJECTED = metrics.counter("jira_requests_rejected_total", "Jira calls failed fast by the open circuit breaker.")
+
+
+class ByteBudget:
+    # Caps the total size of attachments streamed through the process at once.
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, size: int) -> int:
+        size = min(max(size, 1), self.limit)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_use + size <= self.limit)
+            self.in_use += size
+        return size
+
+    async def release(self, size: int):
+        async with self._cond:
+            self.in_use -= size
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        reserved = await self.acquire(size)
+        try:
+            yield
+        finally:
+            await self.release(reserved)
+
+
+class JiraError(Exception):
+    def __init__(self, status: int, body):
+        super().__init__(f"Jira ответила {status}: {body}")
+        self.status = status
+        self.body = body
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 429 or self.status >= 500
+
+
+class JiraUnavailable(JiraError):
+    # Raised without contacting Jira while the circuit breaker is open.
+    # Work that hits it should be postponed, not counted as a failed attempt.
+    deferred = True
+
+    def __init__(self, retry_in: float):
+        Exception.__init__(self, f"Jira недоступна, следующая попытка через {retry_in:.0f} с")
+        self.status = 503
+        self.body = None
+        self.retry_after = retry_in
+
+
+def parse_retry_after(value) -> float | None:
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), RETRY_AFTER_MAX)
+
+
+class JiraGovernor:
+    # Guards every Jira call.
+    # - Concurrency adapts AIMD-style: each fast success raises the limit by
+    #   1/limit (about one slot per round of requests), while a 429, a 5xx,
+    #   a network error or a call slower than latency_target halves it, at
+    #   most once per latency_target.
+    # - Retry-After holds back all calls until it expires.
+    # - failure_threshold overload failures in a row open the circuit
+    #   breaker. Calls then fail fast with JiraUnavailable until the cooldown
+    #   passes and a single probe call succeeds; each failed probe doubles
+    #   the cooldown.
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, max_limit: int, min_limit: int = GOVERNOR_MIN_LIMIT,
+                 initial_limit: int = GOVERNOR_INITIAL_LIMIT, latency_target: float = LATENCY_TARGET,
+                 failure_threshold: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.latency_target = latency_target
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self.throttled = 0
+        self._cond = asyncio.Condition()
+        CONCURRENCY_LIMIT.set(self.limit)
+        BREAKER_STATE.set(0)
+
+    def _set_state(self, state: str):
+        self.state = state
+        BREAKER_STATE.set(self.STATE_CODES[state])
+
+    def retry_in(self) -> float:
+        # Seconds until a call would be let through; 0 when Jira looks healthy.
+        now = time.monotonic()
+        wait = max(0.0, self.blocked_until - now)
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.cooldown - now
+            if remaining > 0:
+                return max(wait, remaining)
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN and self.probing:
+            return max(wait, 1.0)
+        return wait
+
+    def _reject(self):
+        self.rejected += 1
+        REJECTED.inc()
+        raise JiraUnavailable(self.retry_in())
+
+    def _admit(self) -> bool:
+        # Returns True when the call is the half-open probe.
+        self.retry_in()
+        if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probing):
+            self._reject()
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+            return True
+        return False
+
+    @asynccontextmanager
+    async def slot(self):
+        probe = self._admit()
+        try:
+            delay = self.blocked_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._cond:
+                await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+                self.in_flight += 1
+            try:
+                # The breaker may have opened while this call was queued.
+                if not probe and self.state == self.OPEN:
+                    self._reject()
+                yield
+            finally:
+                async with self._cond:
+                    self.in_flight -= 1
+                    self._cond.notify_all()
+        finally:
+            if probe:
+                self.probing = False
+
+    def observe(self, status, latency: float | None, retry_after: float | None = None):
+        # status is the HTTP status, or None when the call raised.
+        now = time.monotonic()
+        if retry_after and (status == 429 or status == 503):
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        if status is None or status == 429 or status >= 500:
+            self._decrease(now)
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._trip(now)
+            return
+        self.failures = 0
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+            self.cooldown = self.base_cooldown
+        if latency is not None and latency > self.latency_target:
+            self._decrease(now)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            CONCURRENCY_LIMIT.set(self.limit)
+
+    def _decrease(self, now: float):
+        if now - self.last_decrease < self.latency_target:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * LIMIT_DECREASE_FACTOR)
+        CONCURRENCY_LIMIT.set(self.limit)
+
+    def _trip(self, now: float):
+        if self.state == self.HALF_OPEN:
+            self.cooldown = min(BREAKER_MAX_COOLDOWN, self.cooldown * 2)
+        elif self.state == self.OPEN:
+            return
+        self._set_state(self.OPEN)
+        self.opened_at = now
+        self.trips += 1
+        BREAKER_TRIPS.inc()
+        print(f"Jira не отвечает, запросы приостановлены на {self.cooldown:.0f} с")
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "failures": self.failures,
+            "retry_in": self.retry_in(),
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "throttled": self.throttled,
+        }
+
+
+class UploadSource:
+    # Wraps the chunk iterator of one uploaded file and records whether a
+    # failed upload was the source's fault: it raised, or the request gave
+    # up while waiting for its next chunk (a slow Telegram download or the
+    # byte budget). Such failures say nothing about Jira's health.
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.reading = False
+        self.error = None
+
+    @property
+    def failed(self) -> bool:
+        return self.reading or self.error is not None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.reading = True
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            raise
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.reading = False
+
+
+class JiraStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def observe(self, latency: float, ok: bool):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "avg_latency": self.total_latency / self.requests if self.requests else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+
+class JiraClient:
+    def __init__(self, base_url: str, api_url: str, token: str,
+                 connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT,
+                 total_timeout: float = TOTAL_TIMEOUT,
+                 limit_per_host: int = CONNECTIONS_PER_HOST,
+                 stream_buffer_size: int = STREAM_BUFFER_SIZE,
+                 attachment_bytes_budget: int = ATTACHMENT_BYTES_BUDGET):
+        self.base_url = base_url.rstrip("/")
+        self.api_url = api_url
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.limit_per_host = limit_per_host
+        self.auth_headers = {"Authorization": f"Bearer {token}"}
+        self.json_headers = {**self.auth_headers, "Content-Type": "application/json"}
+        self.attachment_headers = {**self.auth_headers, "X-Atlassian-Token": "no-check"}
+        self.stream_buffer_size = stream_buffer_size
+        self.byte_budget = ByteBudget(attachment_bytes_budget)
+        self.stats = JiraStats()
+        self.governor = JiraGovernor(limit_per_host)
+        self.session: aiohttp.ClientSession | None = None
+
+    async def start(self):
+        if self.session is not None:
+            return
+        ssl_context = ssl.create_default_context(cafile=certifi.where())
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ssl=ssl_context,
+        )
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_created)
+        trace.on_connection_reuseconn.append(self._on_connection_reused)
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=self.timeout, trace_configs=[trace],
+            read_bufsize=self.stream_buffer_size,
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _on_connection_created(self, session, ctx, params):
+        self.stats.connections_created += 1
+        CONNECTIONS.inc(result="created")
+
+    async def _on_connection_reused(self, session, ctx, params):
+        self.stats.connections_reused += 1
+        CONNECTIONS.inc(result="reused")
+
+    def attachments_url(self, issue_key: str) -> str:
+        return f"{self.base_url}/rest/api/2/issue/{issue_key}/attachments"
+
+    def browse_url(self, issue_key: str) -> str:
+        return f"{self.base_url}/browse/{issue_key}"
+
+    async def request(self, method: str, url: str, endpoint: str = "other", sources=(), **kwargs):
+        # Returns (status, body); body is parsed JSON when Jira sends JSON.
+        # Raises JiraUnavailable while the governor's circuit breaker is open.
+        # sources are the UploadSource objects the request body reads from.
+        async with self.governor.slot():
+            started = time.perf_counter()
+            ok = False
+            status = None
+            retry_after = None
+            cancelled = False
+            try:
+                with metrics.track(REQUEST_SECONDS, IN_FLIGHT, endpoint=endpoint), \
+                        metrics.span("jira." + endpoint, method=method):
+                    async with self.session.request(method, url, **kwargs) as response:
+                        status = response.status
+                        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                        if response.content_type == "application/json":
+                            body = await response.json()
+                        else:
+                            body = await response.text()
+                        ok = response.status < 400
+                        return response.status, body
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                latency = time.perf_counter() - started
+                self.stats.observe(latency, ok)
+                source_failed = status is None and any(source.failed for source in sources)
+                REQUESTS_TOTAL.inc(endpoint=endpoint, status=status or ("source_error" if source_failed else "error"))
+                if not cancelled and not source_failed:
+                    # Upload time depends on file size, so it says little
+                    # about how loaded Jira is.
+                    self.governor.observe(status, None if endpoint == "attachments" else latency, retry_after)
+
+    async def create_issue(self, payload: dict):
+        return await self.request(
+            "POST", self.api_url, endpoint="create_issue", headers=self.json_headers, json=payload
+        )
+
+    async def search(self, jql: str, fields=("status",), start_at: int = 0, max_results: int = 100):
+        # validateQuery=warn turns unknown keys in `key in (...)` into
+        # warnings instead of failing the whole query.
+        return await self.request(
+            "POST", f"{self.base_url}/rest/api/2/search", endpoint="search", headers=self.json_headers,
+            json={
+                "jql": jql, "fields": list(fields), "startAt": start_at,
+                "maxResults": max_results, "validateQuery": "warn",
+            },
+        )
+
+    async def upload_attachment(self, issue_key: str, filename: str, chunks):
+        return await self.upload_attachments(issue_key, [(filename, chunks)])
+
+    async def upload_attachments(self, issue_key: str, files):
+        # files is a list of (filename, chunks) where chunks is an async
+        # iterator of bytes. Every file becomes its own "file" part of one
+        # multipart body sent with chunked transfer encoding, so no file is
+        # ever held whole in memory.
+        sources = []
+        with aiohttp.MultipartWriter("form-data") as form:
+            for filename, chunks in files:
+                source = UploadSource(chunks)
+                sources.append(source)
+                part = form.append(source)
+                part.set_content_disposition("form-data", name="file", filename=filename)
+        return await self.request(
+            "POST", self.attachments_url(issue_key), endpoint="attachments",
+            headers=self.attachment_headers, data=form, sources=sources,
+        )
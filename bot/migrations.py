@@ -0,0 +1,263 @@
+import datetime
+
+# Each migration runs once, in order, inside its own transaction. The
+# applied version is recorded in schema_version. Steps must also be safe
+# to run against a database created before versioning existed.
+
+RU_MONTHS = {
+    "января": 1, "февраля": 2, "марта": 3, "апреля": 4, "мая": 5, "июня": 6,
+    "июля": 7, "августа": 8, "сентября": 9, "октября": 10, "ноября": 11, "декабря": 12,
+}
+
+
+def parse_legacy_created_at(value):
+    # Old rows store datetime.now().strftime("%d %B %Y, %H:%M") in whatever
+    # locale the bot ran with.
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(datetime.datetime.strptime(value, "%d %B %Y, %H:%M").timestamp())
+    except ValueError:
+        pass
+    try:
+        day, month, year, clock = value.replace(",", "").split()
+        hour, minute = clock.split(":")
+        moment = datetime.datetime(int(year), RU_MONTHS[month.lower()], int(day), int(hour), int(minute))
+        return int(moment.timestamp())
+    except (ValueError, KeyError):
+        return None
+
+
+async def create_base_tables(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            chat_id TEXT
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            task_key TEXT,
+            summary TEXT,
+            state TEXT,
+            created_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS block (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER UNIQUE,
+            reason TEXT DEFAULT '',
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS auth_attempts (
+            chat_id INTEGER PRIMARY KEY,
+            attempts INTEGER DEFAULT 0,
+            username TEXT,
+            last_try TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+
+async def create_tasks_indexes(db):
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tasks_task_key ON tasks(task_key)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_id ON tasks(user_id)")
+
+
+async def add_lookup_indexes(db):
+    # A unique index cannot be built over duplicates; keep the newest row.
+    await db.execute("""
+        DELETE FROM tasks
+        WHERE task_key IS NOT NULL
+          AND id NOT IN (SELECT MAX(id) FROM tasks WHERE task_key IS NOT NULL GROUP BY task_key)
+    """)
+    await create_tasks_indexes(db)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_chat_id ON users(chat_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_block_username ON block(username)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_auth_attempts_username ON auth_attempts(username)")
+
+
+async def tasks_created_at_to_epoch(db):
+    async with db.execute("PRAGMA table_info(tasks)") as cursor:
+        columns = {row[1]: row[2] for row in await cursor.fetchall()}
+    if columns.get("created_at", "").upper() == "INTEGER":
+        return
+
+    await db.execute("""
+        CREATE TABLE tasks_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            task_key TEXT,
+            summary TEXT,
+            state TEXT,
+            created_at INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    async with db.execute("SELECT id, user_id, task_key, summary, state, created_at FROM tasks") as cursor:
+        rows = [
+            (row_id, user_id, task_key, summary, state, parse_legacy_created_at(created_at))
+            for row_id, user_id, task_key, summary, state, created_at in await cursor.fetchall()
+        ]
+    await db.executemany("""
+        INSERT INTO tasks_new (id, user_id, task_key, summary, state, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    await db.execute("DROP TABLE tasks")
+    await db.execute("ALTER TABLE tasks_new RENAME TO tasks")
+    await create_tasks_indexes(db)
+
+
+async def create_outbox(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL DEFAULT 0,
+            task_key TEXT,
+            attached INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+
+
+async def create_fsm_state(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated_at ON fsm_state(updated_at)")
+
+
+async def create_sync_state(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            high_water_mark INTEGER,
+            claimed_at INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+
+async def create_photo_cache(db):
+    # Downloaded photos are stored once per content hash; file_unique_id
+    # maps Telegram's id of a photo to that content.
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS photo_blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_used INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_photo_blobs_last_used ON photo_blobs(last_used)")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS photo_files (
+            file_unique_id TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL REFERENCES photo_blobs(sha256)
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_photo_files_sha256 ON photo_files(sha256)")
+
+
+async def create_tasks_archive(db, schema: str = "main"):
+    # Finished tasks moved out of `tasks` by retention.py. Rows keep their
+    # ids, so paging continues from the live table into the archive. Also
+    # called for an archive database attached under another schema name.
+    await db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.tasks_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            task_key TEXT,
+            summary TEXT,
+            state TEXT,
+            created_at INTEGER,
+            archived_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_tasks_archive_user_id ON tasks_archive(user_id, id)")
+    await db.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_tasks_archive_task_key ON tasks_archive(task_key)")
+    if schema == "main":
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks(created_at)")
+
+
+async def add_outbox_attached_photos(db):
+    # Photos already attached to the item's issue, by file_unique_id (or
+    # file_id for old items), as a JSON list.
+    async with db.execute("PRAGMA table_info(outbox)") as cursor:
+        columns = {row[1] async for row in cursor}
+    if "attached_photos" not in columns:
+        await db.execute("ALTER TABLE outbox ADD COLUMN attached_photos TEXT NOT NULL DEFAULT '[]'")
+
+
+async def enable_incremental_vacuum(db, schema: str = "main"):
+    # auto_vacuum can only be switched on an existing file by rebuilding it
+    # with VACUUM, which cannot run inside a transaction, so this is not a
+    # numbered migration. The rebuild locks the database for as long as it
+    # takes, so it is run by retention.TaskArchiver under its claim rather
+    # than at startup, where it made the other workers' migrations time out.
+    # It runs once; later calls see the mode already set.
+    async with db.execute(f"PRAGMA {schema}.auto_vacuum") as cursor:
+        if (await cursor.fetchone())[0] == 2:
+            return
+    await db.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+    await db.execute(f"VACUUM {schema}")
+    print(f"База {schema} переведена в режим auto_vacuum = INCREMENTAL")
+
+
+MIGRATIONS = [
+    (1, create_base_tables),
+    (2, add_lookup_indexes),
+    (3, tasks_created_at_to_epoch),
+    (4, create_outbox),
+    (5, create_fsm_state),
+    (6, create_sync_state),
+    (7, create_photo_cache),
+    (8, create_tasks_archive),
+    (9, add_outbox_attached_photos),
+]
+
+
+async def current_version(db) -> int:
+    async with db.execute("SELECT MAX(version) FROM schema_version") as cursor:
+        return (await cursor.fetchone())[0] or 0
+
+
+async def migrate(db):
+    await db.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    await db.commit()
+
+    for version, step in MIGRATIONS:
+        # BEGIN IMMEDIATE takes the write lock, so several processes starting
+        # at once apply every step exactly once.
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            if await current_version(db) >= version:
+                await db.commit()
+                continue
+            await step(db)
+            await db.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+        print(f"Применена миграция БД: {version} ({step.__name__})")
@@ -0,0 +1,136 @@
+import asyncio
+import random
+import time
+import task_storage
+
+OUTBOX_WORKERS = 4
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_MAX = 600
+OUTBOX_LEASE = 300
+OUTBOX_HEARTBEAT = OUTBOX_LEASE / 3
+OUTBOX_POLL_INTERVAL = 30
+
+
+class OutboxDispatcher:
+    # Drains the outbox table with a pool of workers. `deliver` does the work
+    # for one item. Exceptions are retried with exponential backoff, unless
+    # they carry retryable=False or the item is out of attempts; `on_failure`
+    # is then called once. Exceptions with deferred=True put the item back
+    # for their retry_after without using up an attempt. `gate`, if given,
+    # returns how many seconds to hold off claiming items, e.g. while Jira's
+    # circuit breaker is open. The lease of an item is renewed every
+    # OUTBOX_HEARTBEAT seconds while it is being delivered, so a slow delivery
+    # is never claimed a second time.
+
+    def __init__(self, deliver, on_failure, workers: int = OUTBOX_WORKERS, gate=None):
+        self.deliver = deliver
+        self.on_failure = on_failure
+        self.workers_count = workers
+        self.gate = gate
+        self.workers = []
+        self.delivered = 0
+        self.retried = 0
+        self.deferred = 0
+        self.failed = 0
+        self._wakeup = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _idle_wait(self):
+        timeout = OUTBOX_POLL_INTERVAL
+        next_at = await task_storage.next_outbox_attempt_at()
+        if next_at is not None:
+            timeout = min(timeout, max(0.0, next_at - time.time()))
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _worker(self):
+        while True:
+            hold_off = self.gate() if self.gate is not None else 0
+            if hold_off > 0:
+                await asyncio.sleep(min(hold_off, OUTBOX_POLL_INTERVAL))
+                continue
+            try:
+                item = await task_storage.claim_outbox_item(OUTBOX_LEASE)
+            except Exception as e:
+                print("Ошибка при чтении очереди задач:", str(e))
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+                continue
+            if item is None:
+                await self._idle_wait()
+                continue
+            await self._process(item)
+
+    async def _heartbeat(self, item):
+        while True:
+            await asyncio.sleep(OUTBOX_HEARTBEAT)
+            try:
+                if not await task_storage.renew_outbox_lease(item.id, item.attempts, OUTBOX_LEASE):
+                    print(f"Заявка {item.id}: аренда потеряна")
+                    return
+            except Exception as e:
+                print(f"Заявка {item.id}: не удалось продлить аренду:", str(e))
+
+    async def _deliver(self, item):
+        heartbeat = asyncio.create_task(self._heartbeat(item))
+        try:
+            await self.deliver(item)
+        finally:
+            heartbeat.cancel()
+
+    async def _process(self, item):
+        try:
+            await self._deliver(item)
+        except asyncio.CancelledError:
+            await asyncio.shield(task_storage.retry_outbox_item(item.id, 0, "прервано остановкой бота"))
+            raise
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            if getattr(e, "deferred", False):
+                self.deferred += 1
+                await task_storage.defer_outbox_item(item.id, getattr(e, "retry_after", 0), error)
+                return
+            if getattr(e, "retryable", True) and item.attempts < OUTBOX_MAX_ATTEMPTS:
+                self.retried += 1
+                delay = self._backoff(item.attempts)
+                print(f"Заявка {item.id}: попытка {item.attempts} не удалась ({error}), повтор через {delay:.0f} с")
+                await task_storage.retry_outbox_item(item.id, delay, error)
+                self.notify()
+            else:
+                self.failed += 1
+                print(f"Заявка {item.id} отклонена: {error}")
+                await task_storage.fail_outbox_item(item.id, error)
+                try:
+                    await self.on_failure(item, error)
+                except Exception as e:
+                    print(f"Не удалось сообщить об ошибке по заявке {item.id}:", str(e))
+            return
+        self.delivered += 1
+        await task_storage.complete_outbox_item(item.id)
+
+    def stats(self):
+        return {
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "deferred": self.deferred,
+            "failed": self.failed,
+        }
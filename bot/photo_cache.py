@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import os
+import time
+import uuid
+import task_storage
+from common import metrics
+
+PHOTO_CACHE_DIR = ""
+PHOTO_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Well above the bot's download timeout: a .part file not written to for
+# this long belongs to a process that died mid-download.
+STALE_PART_AGE = 10 * 60
+
+LOOKUPS = metrics.counter("photo_cache_lookups_total", "Photo cache lookups by result.", ("result",))
+BYTES_SAVED = metrics.counter("photo_cache_bytes_saved_total", "Photo bytes served from disk instead of Telegram.")
+EVICTIONS = metrics.counter("photo_cache_evictions_total", "Cached photos evicted to stay under the size limit.")
+
+
+class PhotoCache:
+    # Photos already sent to Jira once, kept on disk under their sha256 and
+    # indexed by Telegram's file_unique_id, so a screenshot attached to
+    # several issues is downloaded from Telegram only once. The index lives
+    # in the bot's database; least recently used content is evicted once
+    # the files exceed max_bytes. An empty directory means "next to the
+    # database"; max_bytes=0 turns the cache off.
+
+    def __init__(self, directory: str = PHOTO_CACHE_DIR, max_bytes: int = PHOTO_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.hash_hits = 0
+        self.bytes_saved = 0
+        self.bytes_stored = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def open(self):
+        if not self.enabled:
+            return
+        if not self.directory:
+            self.directory = os.path.join(os.path.dirname(task_storage.DB_PATH) or ".", "photo_cache")
+        os.makedirs(self.directory, exist_ok=True)
+        # Other workers share the directory, so only abandoned downloads are
+        # removed, not the ones still being written.
+        stale_before = time.time() - STALE_PART_AGE
+        for name in os.listdir(self.directory):
+            if not name.endswith(".part"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < stale_before:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256)
+
+    async def lookup(self, file_unique_id: str) -> str | None:
+        if not self.enabled:
+            return None
+        row = await task_storage.touch_cached_photo(file_unique_id)
+        if row is not None:
+            sha256, size = row
+            path = self.path(sha256)
+            if os.path.exists(path):
+                self.hits += 1
+                self.bytes_saved += size
+                LOOKUPS.inc(result="hit")
+                BYTES_SAVED.inc(size)
+                return path
+            await task_storage.forget_cached_photo(sha256)
+        self.misses += 1
+        LOOKUPS.inc(result="miss")
+        return None
+
+    def writer(self, file_unique_id: str):
+        return CacheWriter(self, file_unique_id) if self.enabled else None
+
+    async def _store(self, file_unique_id: str, temp_path: str, sha256: str, size: int):
+        path = self.path(sha256)
+        if os.path.exists(path):
+            # Same content under another file_unique_id.
+            self.hash_hits += 1
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+            self.bytes_stored += size
+        total = await task_storage.add_cached_photo(file_unique_id, sha256, size)
+        if total > self.max_bytes:
+            for evicted in await task_storage.evict_cached_photos(self.max_bytes):
+                self.evictions += 1
+                EVICTIONS.inc()
+                try:
+                    os.remove(self.path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "hash_hits": self.hash_hits,
+            "bytes_saved": self.bytes_saved,
+            "bytes_stored": self.bytes_stored,
+            "evictions": self.evictions,
+        }
+
+
+class CacheWriter:
+    # Copies a download into the cache while it is being uploaded. The file
+    # only becomes visible in the cache on commit(), after the whole body
+    # has been read.
+
+    def __init__(self, cache: PhotoCache, file_unique_id: str):
+        self.cache = cache
+        self.file_unique_id = file_unique_id
+        self.temp_path = os.path.join(cache.directory, f"{uuid.uuid4().hex}.part")
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.file = None
+
+    async def write(self, chunk: bytes):
+        if self.file is None:
+            self.file = open(self.temp_path, "wb")
+        await asyncio.to_thread(self.file.write, chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    async def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            await self.cache._store(self.file_unique_id, self.temp_path, self.hash.hexdigest(), self.size)
+        except Exception as e:
+            print(f"Не удалось сохранить фото {self.file_unique_id} в кэш:", str(e))
+            self.discard()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
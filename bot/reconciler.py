@@ -0,0 +1,115 @@
+import asyncio
+import math
+import time
+import task_storage
+from jira_client import JiraError
+from common.statuses import STATUS_MAP, UNKNOWN_STATUS
+
+SYNC_NAME = "jira_status"
+RECONCILE_INTERVAL = 5 * 60
+RECONCILE_BATCH_SIZE = 500
+RECONCILE_PAGE_SIZE = 100
+RECONCILE_OVERLAP = 2 * 60
+
+
+class StatusReconciler:
+    # Catches up on status changes whose webhook never reached the listener.
+    # Every `interval` seconds the open tasks are sent to Jira search in
+    # batches of `batch_size` keys, asking only for issues updated since the
+    # previous run and only for their status field, so a run costs a few
+    # requests rather than one per task. The high-water mark is stored in
+    # sync_state; the claim there also keeps several bot processes from
+    # running the same sync.
+
+    def __init__(self, jira, interval: float = RECONCILE_INTERVAL, batch_size: int = RECONCILE_BATCH_SIZE):
+        self.jira = jira
+        self.interval = interval
+        self.batch_size = batch_size
+        self.runs = 0
+        self.requests = 0
+        self.issues_seen = 0
+        self.tasks_updated = 0
+        self.errors = 0
+        self.last_run_at = None
+        self.last_duration = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.errors += 1
+                print("Ошибка при сверке статусов с Jira:", str(e))
+            await asyncio.sleep(self.interval)
+
+    def _updated_clause(self, high_water_mark, now: float) -> str:
+        if high_water_mark is None:
+            return ""
+        # Relative dates are evaluated by Jira itself, so the server's
+        # timezone does not matter; the overlap covers clock skew.
+        minutes = math.ceil((now - high_water_mark + RECONCILE_OVERLAP) / 60)
+        return f" AND updated >= -{minutes}m"
+
+    async def _search(self, jql: str):
+        start_at = 0
+        while True:
+            self.requests += 1
+            status, body = await self.jira.search(jql, start_at=start_at, max_results=RECONCILE_PAGE_SIZE)
+            if status != 200:
+                raise JiraError(status, body)
+            issues = body.get("issues", [])
+            for issue in issues:
+                yield issue["key"], ((issue.get("fields") or {}).get("status") or {}).get("name")
+            start_at += len(issues)
+            if not issues or start_at >= body.get("total", 0):
+                return
+
+    async def run_once(self, force: bool = False) -> bool:
+        # Returns False when another process ran the sync within the interval.
+        claim = await task_storage.claim_sync(SYNC_NAME, 0 if force else int(self.interval * 0.9))
+        if claim is None:
+            return False
+        started = time.time()
+        updated_clause = self._updated_clause(claim[0], started)
+        states = []
+        after_id = 0
+        while True:
+            rows = await task_storage.get_open_task_keys(after_id, self.batch_size)
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            keys = ", ".join(f'"{task_key}"' for _, task_key in rows)
+            async for task_key, status in self._search(f"key in ({keys}){updated_clause}"):
+                self.issues_seen += 1
+                states.append((task_key, STATUS_MAP.get(status, UNKNOWN_STATUS)))
+            if len(rows) < self.batch_size:
+                break
+        if states:
+            self.tasks_updated += await task_storage.update_task_states(states)
+        # Only advance the mark once every batch succeeded, otherwise the
+        # next run would skip what this one failed to fetch.
+        await task_storage.set_sync_high_water_mark(SYNC_NAME, int(started))
+        self.runs += 1
+        self.last_run_at = int(started)
+        self.last_duration = time.time() - started
+        return True
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "requests": self.requests,
+            "issues_seen": self.issues_seen,
+            "tasks_updated": self.tasks_updated,
+            "errors": self.errors,
+            "last_run_at": self.last_run_at,
+            "last_duration": self.last_duration,
+        }
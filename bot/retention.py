@@ -0,0 +1,104 @@
+import asyncio
+import time
+import task_storage
+
+SYNC_NAME = "task_archive"
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_INTERVAL = 60 * 60
+ARCHIVE_BATCH_SIZE = 200
+ARCHIVE_BATCH_PAUSE = 0.05
+VACUUM_PAGES = 500
+OUTBOX_RETENTION_DAYS = 7
+
+
+class TaskArchiver:
+    # Moves finished tasks older than `max_age_days` from `tasks` to
+    # tasks_archive, so the live table only holds what users and the
+    # listener look at. Each batch is its own short write transaction with a
+    # pause after it, so handlers waiting for the writer get in between.
+    # Freed pages are then returned to the filesystem with incremental
+    # vacuum, in steps of VACUUM_PAGES. Each run also deletes failed outbox
+    # items older than OUTBOX_RETENTION_DAYS, also when archiving is off
+    # (max_age_days = 0). The claim in sync_state keeps several bot
+    # processes from archiving at once; it also makes the first run the only
+    # place where the databases are switched to incremental auto_vacuum.
+
+    def __init__(self, max_age_days: float = ARCHIVE_AFTER_DAYS, interval: float = ARCHIVE_INTERVAL,
+                 batch_size: int = ARCHIVE_BATCH_SIZE):
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.runs = 0
+        self.archived = 0
+        self.outbox_pruned = 0
+        self.batches = 0
+        self.pages_freed = 0
+        self.errors = 0
+        self.last_run_at = None
+        self.last_duration = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.errors += 1
+                print("Ошибка при архивации задач:", str(e))
+            await asyncio.sleep(self.interval)
+
+    async def _vacuum(self, schema: str):
+        while True:
+            freed = await task_storage.incremental_vacuum(VACUUM_PAGES, schema)
+            self.pages_freed += freed
+            if freed < VACUUM_PAGES:
+                return
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+
+    async def run_once(self, force: bool = False) -> bool:
+        # Returns False when another process archived within the interval.
+        claim = await task_storage.claim_sync(SYNC_NAME, 0 if force else int(self.interval * 0.9))
+        if claim is None:
+            return False
+        started = time.time()
+        await task_storage.enable_incremental_vacuum("main")
+        if task_storage.pool.archive_path:
+            await task_storage.enable_incremental_vacuum("archive")
+        created_before = int(started - self.max_age_days * 24 * 60 * 60)
+        while self.max_age_days:
+            moved = await task_storage.archive_tasks(created_before, self.batch_size)
+            self.archived += moved
+            if moved:
+                self.batches += 1
+            if moved < self.batch_size:
+                break
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+        self.outbox_pruned += await task_storage.prune_outbox(int(started - OUTBOX_RETENTION_DAYS * 24 * 60 * 60))
+        # Also reclaims pages freed by deleted outbox items (above and in
+        # complete_outbox_item), expired FSM states and evicted photo cache rows.
+        await self._vacuum("main")
+        await task_storage.set_sync_high_water_mark(SYNC_NAME, int(started))
+        self.runs += 1
+        self.last_run_at = int(started)
+        self.last_duration = time.time() - started
+        return True
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "archived": self.archived,
+            "outbox_pruned": self.outbox_pruned,
+            "batches": self.batches,
+            "pages_freed": self.pages_freed,
+            "errors": self.errors,
+            "last_run_at": self.last_run_at,
+            "last_duration": self.last_duration,
+        }
@@ -0,0 +1,255 @@
+import aiohttp
+import asyncio
+import multiprocessing
+import os
+import secrets
+import signal
+import time
+from aiohttp import web
+
+import config
+import bot as bot_app
+import webhook
+from common import metrics
+
+BOT_WORKERS = getattr(config, "BOT_WORKERS", os.cpu_count() or 1)
+WORKER_BASE_PORT = getattr(config, "WORKER_BASE_PORT", 8100)
+SUPERVISOR_PORT = getattr(config, "SUPERVISOR_PORT", 8090)
+HEALTH_INTERVAL = 5
+HEALTH_FAILURES = 3
+STARTUP_GRACE = 15
+FORWARD_QUEUE_SIZE = 10000
+FORWARD_RETRY_DELAY = 0.5
+POLL_TIMEOUT = 30
+
+FORWARD_SECONDS = metrics.histogram(
+    "supervisor_forward_seconds", "Time from dequeuing an update to the worker accepting it.", ("worker",)
+)
+FORWARD_ERRORS = metrics.counter("supervisor_forward_errors_total", "Failed forwards to a worker.", ("worker",))
+
+
+def worker_main(port: int, secret: str):
+    async def run():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        await bot_app.run_worker(port, secret)
+
+    try:
+        asyncio.run(run())
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
+
+
+class Worker:
+    def __init__(self, index: int, port: int, secret: str, context):
+        self.index = index
+        self.port = port
+        self.secret = secret
+        self.context = context
+        self.url = f"http://127.0.0.1:{port}{webhook.WEBHOOK_PATH}"
+        self.health_url = f"http://127.0.0.1:{port}/healthz"
+        self.queue = asyncio.Queue(maxsize=FORWARD_QUEUE_SIZE)
+        self.process = None
+        self.started_at = time.monotonic()
+        self.forwarded = 0
+        self.forward_errors = 0
+        self.respawns = 0
+        self.health_failures = 0
+        self.health = {}
+
+    def spawn(self):
+        self.process = self.context.Process(
+            target=worker_main, args=(self.port, self.secret), name=f"bot-worker-{self.index}", daemon=True
+        )
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.health_failures = 0
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self, timeout: float = 10):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def stats(self):
+        uptime = time.monotonic() - self.started_at
+        return {
+            "pid": self.process.pid if self.process else None,
+            "alive": self.alive(),
+            "queued": self.queue.qsize(),
+            "forwarded": self.forwarded,
+            "forward_errors": self.forward_errors,
+            "respawns": self.respawns,
+            "updates_per_second": self.forwarded / uptime if uptime else 0.0,
+            "health": self.health,
+        }
+
+
+class Supervisor:
+    # Receives every update (long polling or webhook) and forwards it to one
+    # of the worker processes, chosen by chat_id. All updates of a chat go to
+    # the same worker in arrival order, which the FSM flow relies on.
+
+    def __init__(self, workers: int = BOT_WORKERS, base_port: int = WORKER_BASE_PORT):
+        secret = secrets.token_urlsafe(32)
+        context = multiprocessing.get_context("spawn")
+        self.workers = [Worker(i, base_port + i, secret, context) for i in range(max(1, workers))]
+        self.session = None
+        self.received = 0
+
+    def route(self, data: dict) -> Worker:
+        chat_id = webhook.update_chat_id(data)
+        shard = hash(chat_id) if chat_id is not None else data.get("update_id", 0)
+        return self.workers[shard % len(self.workers)]
+
+    async def dispatch(self, data: dict):
+        self.received += 1
+        await self.route(data).queue.put(data)
+
+    async def _forward(self, worker: Worker):
+        headers = {webhook.SECRET_HEADER: worker.secret}
+        while True:
+            data = await worker.queue.get()
+            started = time.perf_counter()
+            while True:
+                try:
+                    async with self.session.post(worker.url, json=data, headers=headers) as response:
+                        if response.status == 200:
+                            break
+                        worker.forward_errors += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    worker.forward_errors += 1
+                FORWARD_ERRORS.inc(worker=worker.index)
+                # The worker is starting or being respawned; keep the update
+                # and try again so the chat's order is preserved.
+                await asyncio.sleep(FORWARD_RETRY_DELAY)
+            FORWARD_SECONDS.observe(time.perf_counter() - started, worker=worker.index)
+            worker.forwarded += 1
+
+    async def _check(self, worker: Worker):
+        if not worker.alive():
+            print(f"Воркер {worker.index} завершился, перезапускаем")
+            worker.respawns += 1
+            worker.spawn()
+            return
+        try:
+            async with self.session.get(worker.health_url, timeout=aiohttp.ClientTimeout(total=2)) as response:
+                response.raise_for_status()
+                worker.health = await response.json()
+                worker.health_failures = 0
+                return
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if time.monotonic() - worker.started_at < STARTUP_GRACE:
+                return
+            worker.health_failures += 1
+        if worker.health_failures >= HEALTH_FAILURES:
+            print(f"Воркер {worker.index} не отвечает, перезапускаем")
+            await asyncio.to_thread(worker.stop)
+            worker.respawns += 1
+            worker.spawn()
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            await asyncio.gather(*(self._check(worker) for worker in self.workers))
+
+    async def _poll(self):
+        api = bot_app.bot.session.api
+        async with self.session.post(
+            api.api_url(config.API_TOKEN, "deleteWebhook"), json={"drop_pending_updates": False}
+        ):
+            pass
+        allowed_updates = bot_app.create_dispatcher().resolve_used_update_types()
+        offset = None
+        while True:
+            params = {"timeout": POLL_TIMEOUT, "allowed_updates": allowed_updates}
+            if offset is not None:
+                params["offset"] = offset
+            try:
+                async with self.session.post(
+                    api.api_url(config.API_TOKEN, "getUpdates"), json=params, timeout=aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)
+                ) as response:
+                    body = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print("Ошибка при получении обновлений:", str(e))
+                await asyncio.sleep(1)
+                continue
+            if not body.get("ok"):
+                print("Ошибка при получении обновлений:", body)
+                await asyncio.sleep(body.get("parameters", {}).get("retry_after", 1))
+                continue
+            for update in body["result"]:
+                await self.dispatch(update)
+                offset = update["update_id"] + 1
+
+    async def handle_webhook(self, request):
+        if bot_app.WEBHOOK_SECRET and not webhook.secret_matches(request, bot_app.WEBHOOK_SECRET):
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await self.dispatch(data)
+        return web.Response()
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "workers": [worker.stats() for worker in self.workers],
+        }
+
+    async def run(self):
+        if bot_app.BOT_MODE == "webhook":
+            webhook.check_secret(bot_app.WEBHOOK_URL, bot_app.WEBHOOK_SECRET)
+        for worker in self.workers:
+            worker.spawn()
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        app = web.Application()
+        app.router.add_get("/supervisor-stats", self.handle_stats)
+        app.router.add_get("/metrics", metrics.metrics_handler)
+        if bot_app.BOT_MODE == "webhook":
+            app.router.add_post(webhook.WEBHOOK_PATH, self.handle_webhook)
+            host, port = bot_app.WEBHOOK_HOST, bot_app.WEBHOOK_PORT
+        else:
+            host, port = "127.0.0.1", SUPERVISOR_PORT
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        tasks = [asyncio.create_task(self._forward(worker)) for worker in self.workers]
+        tasks.append(asyncio.create_task(self._monitor()))
+        try:
+            if bot_app.BOT_MODE == "webhook":
+                if bot_app.WEBHOOK_URL:
+                    await bot_app.bot.set_webhook(
+                        bot_app.WEBHOOK_URL,
+                        secret_token=bot_app.WEBHOOK_SECRET or None,
+                        allowed_updates=bot_app.create_dispatcher().resolve_used_update_types(),
+                        drop_pending_updates=False,
+                    )
+                await asyncio.Event().wait()
+            else:
+                await self._poll()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await runner.cleanup()
+            await self.session.close()
+            await bot_app.bot.session.close()
+            await asyncio.gather(*(asyncio.to_thread(worker.stop) for worker in self.workers))
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(Supervisor().run())
+    except KeyboardInterrupt:
+        pass
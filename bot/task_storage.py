@@ -1,143 +1,605 @@
 import aiosqlite
-import datetime
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import NamedTuple
+import migrations
+from access_cache import AccessCache
+from common import metrics
 
 DB_PATH = ""
+# Finished tasks are archived into this file when set, otherwise into the
+# tasks_archive table of DB_PATH.
+ARCHIVE_DB_PATH = ""
+READ_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+TASKS_PAGE_SIZE = 10
+TERMINAL_STATES = ("✅ Готово", "🔒 Закрыта", "❌ Отменена")
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                username TEXT,
-                chat_id TEXT
-            )
-        """)
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = 10000;",
+    "PRAGMA busy_timeout = 5000;",
+)
 
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                task_key TEXT,
-                summary TEXT,
-                state TEXT,
-                created_at TEXT,
-                FOREIGN KEY(user_id) REFERENCES users(id)
-            )
-        """)
+QUERY_SECONDS = metrics.histogram(
+    "sqlite_query_seconds", "Latency of task_storage calls, including the wait for a connection.", ("function",)
+)
+QUERY_IN_FLIGHT = metrics.gauge("sqlite_queries_in_flight", "task_storage calls in progress.", ("function",))
+timed = metrics.instrument(QUERY_SECONDS, QUERY_IN_FLIGHT)
+ACCESS_CACHE_LOOKUPS = metrics.counter(
+    "access_cache_lookups_total", "Block list and user lookups, by whether the cached copy was fresh.", ("result",)
+)
 
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS block (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER UNIQUE,
-                reason TEXT DEFAULT '',
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+# -----------------------------
+# CONNECTION POOL
+# -----------------------------
 
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS auth_attempts (
-                chat_id INTEGER PRIMARY KEY,
-                attempts INTEGER DEFAULT 0,
-                username TEXT,
-                last_try TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-
-        await db.execute("PRAGMA journal_mode = WAL;")
-        await db.execute("PRAGMA cache_size = 10000;")
-        await db.commit()
+class StoragePool:
+    # One writer connection serialized by a lock and several WAL readers.
+    # Connections live for the whole process, so sqlite keeps their
+    # prepared statements in its per-connection statement cache.
+
+    def __init__(self, db_path: str, readers: int = READ_POOL_SIZE, archive_path: str = ""):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.readers_count = max(1, readers)
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all = []
+
+    async def _connect(self, read_only=False):
+        db = await aiosqlite.connect(self.db_path, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        if self.archive_path:
+            await db.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+            # Switching a new file to WAL only completes once the result is read.
+            async with db.execute("PRAGMA archive.journal_mode = WAL;") as cursor:
+                await cursor.fetchall()
+        if read_only:
+            await db.execute("PRAGMA query_only = ON;")
+        self._all.append(db)
+        return db
+
+    async def open(self):
+        self._writer = await self._connect()
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect(read_only=True))
+
+    async def close(self):
+        async with self._write_lock:
+            for db in self._all:
+                await db.close()
+            self._all.clear()
+            self._writer = None
+
+    @asynccontextmanager
+    async def read(self):
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def write(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+
+pool: StoragePool | None = None
+
+async def open_pool(db_path: str = None, readers: int = READ_POOL_SIZE, archive_path: str = None):
+    global pool
+    if pool is None:
+        pool = StoragePool(db_path or DB_PATH, readers, ARCHIVE_DB_PATH if archive_path is None else archive_path)
+        await pool.open()
+    return pool
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+async def _fetchone(sql, params=()):
+    async with pool.read() as db:
+        async with db.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+async def _fetchall(sql, params=()):
+    async with pool.read() as db:
+        async with db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+async def _execute(sql, params=()):
+    async with pool.write() as db:
+        await db.execute(sql, params)
+
+# -----------------------------
+# ACCESS CACHE
+# -----------------------------
+
+access = AccessCache()
 
+async def _access_cache() -> AccessCache:
+    if access.fresh():
+        access.hits += 1
+        ACCESS_CACHE_LOOKUPS.inc(result="hit")
+        return access
+    async with access.lock:
+        if not access.fresh():
+            access.misses += 1
+            ACCESS_CACHE_LOOKUPS.inc(result="miss")
+            async with pool.read() as db:
+                await access.load(db)
+        else:
+            access.hits += 1
+            ACCESS_CACHE_LOOKUPS.inc(result="hit")
+    return access
+
+# -----------------------------
+# SCHEMA
+# -----------------------------
+
+async def init_db():
+    await open_pool()
+    async with pool.write() as db:
+        await migrations.migrate(db)
+    if pool.archive_path:
+        async with pool.write() as db:
+            await migrations.create_tasks_archive(db, "archive")
+
+def _archive_table() -> str:
+    return "archive.tasks_archive" if pool.archive_path else "tasks_archive"
+
+# -----------------------------
+# QUERIES
+# -----------------------------
+
+@timed
 async def in_block(chat_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM block WHERE chat_id = ?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()
-        return row is not None
+    return chat_id in (await _access_cache()).blocked_chat_ids
 
+@timed
 async def get_blocked_user_by_username(username: str) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM block WHERE username = ?", (username,)) as cursor:
-            row = await cursor.fetchone()
-        return row is not None
+    return username in (await _access_cache()).blocked_usernames
 
+@timed
 async def in_active(chat_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM users WHERE chat_id = ?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()
-        return row is not None
+    return chat_id in (await _access_cache()).active_chat_ids
 
 
+@timed
 async def block_user(chat_id: int, block_reason: str, username: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO block (chat_id, reason, username) VALUES (?, ?, ?)",
-            (chat_id, block_reason, username)
-        )
-        await db.commit()
+    await _execute(
+        "INSERT OR IGNORE INTO block (chat_id, reason, username) VALUES (?, ?, ?)",
+        (chat_id, block_reason, username)
+    )
+    access.block(chat_id, username)
 
+@timed
 async def remove_from_blocked(username: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "DELETE FROM block WHERE username = (?)",
+    async with pool.write() as db:
+        async with db.execute(
+            "DELETE FROM block WHERE username = (?) RETURNING chat_id",
             (username,)
-        )
-        await db.commit()
+        ) as cursor:
+            chat_ids = [row[0] for row in await cursor.fetchall()]
+    access.unblock(username, chat_ids)
 
+@timed
 async def clear_auth_attempts(chat_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM auth_attempts WHERE chat_id = ?", (chat_id,))
-        await db.commit()
+    await _execute("DELETE FROM auth_attempts WHERE chat_id = ?", (chat_id,))
 
+@timed
 async def clear_auth_attempts_username(username: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM auth_attempts WHERE username = ?", (username,))
-        await db.commit()
+    await _execute("DELETE FROM auth_attempts WHERE username = ?", (username,))
 
+@timed
 async def get_auth_attempts(chat_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT attempts FROM auth_attempts WHERE chat_id = ?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()
-        return row[0] if row else 0
+    row = await _fetchone("SELECT attempts FROM auth_attempts WHERE chat_id = ?", (chat_id,))
+    return row[0] if row else 0
 
 
-async def increment_auth_attempts(chat_id: int, username: str):
-    if await get_auth_attempts(chat_id) == 0:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("INSERT INTO auth_attempts (chat_id, attempts, username) VALUES (?, 1, ?)", (chat_id, username))
-            await db.commit()
-    else:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE auth_attempts SET attempts = attempts + 1, last_try = CURRENT_TIMESTAMP WHERE chat_id = ?",
-                (chat_id,)
-            )
-            await db.commit()
+@timed
+async def increment_auth_attempts(chat_id: int, username: str) -> int:
+    # One statement, so concurrent attempts from the same chat cannot both
+    # read the old count. Returns the count after this attempt.
+    async with pool.write() as db:
+        async with db.execute("""
+            INSERT INTO auth_attempts (chat_id, attempts, username) VALUES (?, 1, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                attempts = attempts + 1, username = excluded.username, last_try = CURRENT_TIMESTAMP
+            RETURNING attempts
+        """, (chat_id, username)) as cursor:
+            return (await cursor.fetchone())[0]
+
+@timed
+async def block_users(rows):
+    # rows is a list of (chat_id, reason, username), already in the access
+    # cache through access.block_unsaved().
+    async with pool.write() as db:
+        await db.executemany("INSERT OR IGNORE INTO block (chat_id, reason, username) VALUES (?, ?, ?)", rows)
+    access.saved(chat_id for chat_id, _, _ in rows)
 
+@timed
 async def add_user(message):
     user_id = message.from_user.id
     username = message.from_user.username
     chat_id = message.chat.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT OR IGNORE INTO users (id, username, chat_id) VALUES (?, ?, ?)
-        """, (user_id, username, chat_id))
-        await db.commit()
+    if (await _access_cache()).knows_user(user_id, chat_id):
+        return
+    await _execute("""
+        INSERT OR IGNORE INTO users (id, username, chat_id) VALUES (?, ?, ?)
+    """, (user_id, username, chat_id))
+    access.add_user(user_id, chat_id)
 
+@timed
 async def save_task(user_id: int, task_key: str, summary: str, state: str):
-    created_at = datetime.datetime.now().strftime("%d %B %Y, %H:%M")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO tasks (user_id, task_key, summary, state, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, task_key, summary, state, created_at))
-        await db.commit()
+    created_at = int(time.time())
+    await _execute("""
+        INSERT OR IGNORE INTO tasks (user_id, task_key, summary, state, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, task_key, summary, state, created_at))
+
+@timed
+async def get_tasks_page(user_id: int, before_id: int = None, after_id: int = None,
+                         limit: int = TASKS_PAGE_SIZE, finished: bool = None, archived: bool = False):
+    # Keyset pagination over (user_id, id), newest first. before_id pages to
+    # older tasks, after_id to newer ones. Rows are
+    # (id, task_key, summary, state, created_at). archived pages through
+    # tasks_archive instead of the live table.
+    conditions = ["user_id = ?"]
+    params = [user_id]
+    if finished is True:
+        conditions.append(f"state IN ({', '.join('?' * len(TERMINAL_STATES))})")
+        params.extend(TERMINAL_STATES)
+    elif finished is False:
+        conditions.append(f"(state IS NULL OR state NOT IN ({', '.join('?' * len(TERMINAL_STATES))}))")
+        params.extend(TERMINAL_STATES)
+    order = "DESC"
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+        order = "ASC"
+    elif before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    params.append(limit)
+    rows = await _fetchall(f"""
+        SELECT id, task_key, summary, state, created_at
+        FROM {_archive_table() if archived else 'tasks'}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id {order}
+        LIMIT ?
+    """, params)
+    if order == "ASC":
+        rows.reverse()
+    return rows
+
+async def iter_tasks_for_user(user_id: int, page_size: int = TASKS_PAGE_SIZE, finished: bool = None):
+    before_id = None
+    while True:
+        rows = await get_tasks_page(user_id, before_id=before_id, limit=page_size, finished=finished)
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        before_id = rows[-1][0]
 
+@timed
 async def get_tasks_for_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    return [row[1:] async for row in iter_tasks_for_user(user_id)]
+
+# -----------------------------
+# OUTBOX
+# -----------------------------
+
+class OutboxItem(NamedTuple):
+    id: int
+    user_id: int
+    chat_id: int
+    payload: dict
+    attempts: int
+    task_key: str | None
+    attached: bool
+    attached_photos: list[str]
+
+@timed
+async def enqueue_issue(user_id: int, chat_id: int, payload: dict) -> int:
+    async with pool.write() as db:
+        cursor = await db.execute("""
+            INSERT INTO outbox (user_id, chat_id, payload, created_at)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, chat_id, json.dumps(payload, ensure_ascii=False), int(time.time())))
+        return cursor.lastrowid
+
+@timed
+async def claim_outbox_item(lease: int) -> OutboxItem | None:
+    # A claimed item stays "processing" until the lease expires; if the
+    # process dies meanwhile, the item becomes due again and is picked up
+    # after a restart.
+    now = int(time.time())
+    async with pool.write() as db:
+        async with db.execute("""
+            UPDATE outbox
+            SET status = 'processing', attempts = attempts + 1, next_attempt_at = ?
+            WHERE id = (
+                SELECT id FROM outbox
+                WHERE status IN ('pending', 'processing') AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, id
+                LIMIT 1
+            )
+            RETURNING id, user_id, chat_id, payload, attempts, task_key, attached, attached_photos
+        """, (now + lease, now)) as cursor:
+            row = await cursor.fetchone()
+    if row is None:
+        return None
+    row_id, user_id, chat_id, payload, attempts, task_key, attached, attached_photos = row
+    return OutboxItem(
+        row_id, user_id, chat_id, json.loads(payload), attempts, task_key, bool(attached), json.loads(attached_photos)
+    )
+
+@timed
+async def renew_outbox_lease(item_id: int, attempts: int, lease: int) -> bool:
+    # Extends the lease of an item still being delivered. attempts identifies
+    # the claim: False means the lease ran out and the item was claimed again.
+    async with pool.write() as db:
         cursor = await db.execute("""
-            SELECT task_key, summary, state, created_at
-            FROM tasks
-            WHERE user_id = ?
-        """, (user_id,))
-        rows = await cursor.fetchall()
-        return rows
\ No newline at end of file
+            UPDATE outbox SET next_attempt_at = ? WHERE id = ? AND status = 'processing' AND attempts = ?
+        """, (int(time.time()) + lease, item_id, attempts))
+        return cursor.rowcount == 1
+
+@timed
+async def next_outbox_attempt_at() -> int | None:
+    row = await _fetchone("""
+        SELECT MIN(next_attempt_at) FROM outbox WHERE status IN ('pending', 'processing')
+    """)
+    return row[0] if row else None
+
+@timed
+async def set_outbox_task_key(item_id: int, task_key: str):
+    await _execute("UPDATE outbox SET task_key = ? WHERE id = ?", (task_key, item_id))
+
+@timed
+async def set_outbox_attached_photos(item_id: int, attached_photos: list[str], done: bool = False):
+    # done means no photo is left to retry, whether or not all were attached.
+    await _execute("""
+        UPDATE outbox SET attached_photos = ?, attached = ? WHERE id = ?
+    """, (json.dumps(attached_photos), int(done), item_id))
+
+@timed
+async def get_outbox_task_key(item_id: int) -> str | None:
+    row = await _fetchone("SELECT task_key FROM outbox WHERE id = ?", (item_id,))
+    return row[0] if row else None
+
+@timed
+async def complete_outbox_issue(item_id: int, user_id: int, task_key: str, summary: str, state: str):
+    # Saves the created task and removes its outbox item in one transaction,
+    # so nothing that happens afterwards can deliver the item again.
+    async with pool.write() as db:
+        await db.execute("""
+            INSERT OR IGNORE INTO tasks (user_id, task_key, summary, state, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (user_id, task_key, summary, state, int(time.time())))
+        await db.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+
+@timed
+async def complete_outbox_item(item_id: int):
+    # The payload holds the author's contact details; nothing needs it once
+    # the issue exists.
+    await _execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+
+@timed
+async def retry_outbox_item(item_id: int, delay: float, error: str):
+    await _execute("""
+        UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?
+    """, (int(time.time() + delay), error, item_id))
+
+@timed
+async def defer_outbox_item(item_id: int, delay: float, error: str):
+    # Like retry_outbox_item, but the attempt does not count.
+    await _execute("""
+        UPDATE outbox SET status = 'pending', attempts = MAX(attempts - 1, 0), next_attempt_at = ?, last_error = ?
+        WHERE id = ?
+    """, (int(time.time() + delay), error, item_id))
+
+@timed
+async def fail_outbox_item(item_id: int, error: str):
+    await _execute("UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?", (error, item_id))
+
+@timed
+async def prune_outbox(created_before: int) -> int:
+    # Failed items are kept for a while to look into; 'done' rows are left
+    # by versions that did not delete delivered items.
+    async with pool.write() as db:
+        cursor = await db.execute(
+            "DELETE FROM outbox WHERE status IN ('done', 'failed') AND created_at < ?", (created_before,)
+        )
+        return cursor.rowcount
+
+# -----------------------------
+# FSM STATE
+# -----------------------------
+
+@timed
+async def get_fsm_state(key: str, min_updated_at: int):
+    row = await _fetchone(
+        "SELECT state, data FROM fsm_state WHERE key = ? AND updated_at >= ?",
+        (key, min_updated_at)
+    )
+    return row if row else (None, None)
+
+@timed
+async def set_fsm_field(key: str, column: str, value: str | None):
+    if column not in ("state", "data"):
+        raise ValueError(f"Unknown fsm_state column: {column}")
+    async with pool.write() as db:
+        await db.execute(f"""
+            INSERT INTO fsm_state (key, {column}, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at
+        """, (key, value, int(time.time())))
+        if value is None:
+            await db.execute(
+                "DELETE FROM fsm_state WHERE key = ? AND state IS NULL AND data IS NULL", (key,)
+            )
+
+@timed
+async def delete_fsm_states_before(updated_at: int):
+    await _execute("DELETE FROM fsm_state WHERE updated_at < ?", (updated_at,))
+
+# -----------------------------
+# JIRA SYNC
+# -----------------------------
+
+@timed
+async def get_open_task_keys(after_id: int = 0, limit: int = 500):
+    # Rows are (id, task_key) of tasks not in a terminal state, by id.
+    return await _fetchall(f"""
+        SELECT id, task_key FROM tasks
+        WHERE id > ? AND task_key IS NOT NULL
+          AND (state IS NULL OR state NOT IN ({', '.join('?' * len(TERMINAL_STATES))}))
+        ORDER BY id
+        LIMIT ?
+    """, (after_id, *TERMINAL_STATES, limit))
+
+@timed
+async def update_task_states(states) -> int:
+    # states is a list of (task_key, state); returns the number of rows changed.
+    async with pool.write() as db:
+        cursor = await db.executemany(
+            "UPDATE tasks SET state = ? WHERE task_key = ? AND state IS NOT ?",
+            [(state, task_key, state) for task_key, state in states]
+        )
+        return cursor.rowcount
+
+@timed
+async def claim_sync(name: str, interval: int):
+    # Lets one process per interval run the named sync. Returns None when
+    # another run claimed it less than `interval` seconds ago, otherwise
+    # (high_water_mark,), where high_water_mark is None before the first run.
+    now = int(time.time())
+    async with pool.write() as db:
+        await db.execute("INSERT OR IGNORE INTO sync_state (name) VALUES (?)", (name,))
+        async with db.execute("""
+            UPDATE sync_state SET claimed_at = ?
+            WHERE name = ? AND claimed_at <= ?
+            RETURNING high_water_mark
+        """, (now, name, now - interval)) as cursor:
+            return await cursor.fetchone()
+
+@timed
+async def set_sync_high_water_mark(name: str, value: int):
+    await _execute("UPDATE sync_state SET high_water_mark = ? WHERE name = ?", (value, name))
+
+# -----------------------------
+# PHOTO CACHE
+# -----------------------------
+
+@timed
+async def touch_cached_photo(file_unique_id: str):
+    # Returns (sha256, size) of the cached content and marks it used.
+    async with pool.write() as db:
+        async with db.execute("""
+            UPDATE photo_blobs SET last_used = ?
+            WHERE sha256 = (SELECT sha256 FROM photo_files WHERE file_unique_id = ?)
+            RETURNING sha256, size
+        """, (int(time.time()), file_unique_id)) as cursor:
+            return await cursor.fetchone()
+
+@timed
+async def add_cached_photo(file_unique_id: str, sha256: str, size: int) -> int:
+    # Returns the total size of the cached content.
+    async with pool.write() as db:
+        await db.execute("""
+            INSERT INTO photo_blobs (sha256, size, last_used) VALUES (?, ?, ?)
+            ON CONFLICT(sha256) DO UPDATE SET last_used = excluded.last_used
+        """, (sha256, size, int(time.time())))
+        await db.execute(
+            "INSERT OR REPLACE INTO photo_files (file_unique_id, sha256) VALUES (?, ?)",
+            (file_unique_id, sha256)
+        )
+        async with db.execute("SELECT COALESCE(SUM(size), 0) FROM photo_blobs") as cursor:
+            return (await cursor.fetchone())[0]
+
+@timed
+async def evict_cached_photos(max_bytes: int) -> list[str]:
+    # Drops least recently used content until the total fits in max_bytes;
+    # returns the evicted hashes so their files can be removed.
+    evicted = []
+    async with pool.write() as db:
+        async with db.execute("SELECT COALESCE(SUM(size), 0) FROM photo_blobs") as cursor:
+            total = (await cursor.fetchone())[0]
+        async with db.execute("SELECT sha256, size FROM photo_blobs ORDER BY last_used") as cursor:
+            async for sha256, size in cursor:
+                if total <= max_bytes:
+                    break
+                evicted.append(sha256)
+                total -= size
+        for sha256 in evicted:
+            await db.execute("DELETE FROM photo_files WHERE sha256 = ?", (sha256,))
+            await db.execute("DELETE FROM photo_blobs WHERE sha256 = ?", (sha256,))
+    return evicted
+
+@timed
+async def forget_cached_photo(sha256: str):
+    async with pool.write() as db:
+        await db.execute("DELETE FROM photo_files WHERE sha256 = ?", (sha256,))
+        await db.execute("DELETE FROM photo_blobs WHERE sha256 = ?", (sha256,))
+
+# -----------------------------
+# RETENTION
+# -----------------------------
+
+@timed
+async def archive_tasks(created_before: int, limit: int = 500) -> int:
+    # Moves up to `limit` finished tasks created before `created_before` into
+    # the archive in one short transaction; returns how many were moved.
+    # With a separate archive file the move is atomic per database only, so
+    # the insert ignores rows a crashed run already copied.
+    async with pool.write() as db:
+        async with db.execute(f"""
+            SELECT id FROM tasks
+            WHERE created_at < ? AND state IN ({', '.join('?' * len(TERMINAL_STATES))})
+            ORDER BY id
+            LIMIT ?
+        """, (created_before, *TERMINAL_STATES, limit)) as cursor:
+            ids = [row[0] for row in await cursor.fetchall()]
+        if not ids:
+            return 0
+        placeholders = ', '.join('?' * len(ids))
+        await db.execute(f"""
+            INSERT OR IGNORE INTO {_archive_table()} (id, user_id, task_key, summary, state, created_at, archived_at)
+            SELECT id, user_id, task_key, summary, state, created_at, ? FROM tasks WHERE id IN ({placeholders})
+        """, (int(time.time()), *ids))
+        await db.execute(f"DELETE FROM tasks WHERE id IN ({placeholders})", ids)
+        return len(ids)
+
+@timed
+async def enable_incremental_vacuum(schema: str = "main"):
+    async with pool.write() as db:
+        await migrations.enable_incremental_vacuum(db, schema)
+
+@timed
+async def incremental_vacuum(pages: int, schema: str = "main") -> int:
+    # Returns up to `pages` free pages to the filesystem; returns how many
+    # were freed.
+    async with pool.write() as db:
+        async with db.execute(f"PRAGMA {schema}.freelist_count") as cursor:
+            before = (await cursor.fetchone())[0]
+        # Each step of the pragma frees one page. execute() steps a statement
+        # without result columns only once; executescript() runs it to the end.
+        await db.executescript(f"PRAGMA {schema}.incremental_vacuum({int(pages)});")
+        async with db.execute(f"PRAGMA {schema}.freelist_count") as cursor:
+            return before - (await cursor.fetchone())[0]
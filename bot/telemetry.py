@@ -0,0 +1,80 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+
+from common import metrics
+
+METRICS_PATH = "/metrics"
+
+TELEGRAM_SECONDS = metrics.histogram(
+    "telegram_api_seconds", "Latency of Bot API calls made by the bot.", ("method",)
+)
+TELEGRAM_ERRORS = metrics.counter("telegram_api_errors_total", "Bot API calls that raised.", ("method", "error"))
+TELEGRAM_IN_FLIGHT = metrics.gauge("telegram_api_in_flight", "Bot API calls awaiting a response.", ("method",))
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Time spent in update handlers.", ("handler",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Update handlers that raised.", ("handler",))
+UPDATES_TOTAL = metrics.counter("bot_updates_total", "Updates fed to the dispatcher.", ("type",))
+
+
+class TelegramApiMiddleware(BaseRequestMiddleware):
+    # Session middleware: times every request the bot makes to the Bot API.
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        try:
+            with metrics.track(TELEGRAM_SECONDS, TELEGRAM_IN_FLIGHT, method=name), \
+                    metrics.span("telegram." + name):
+                return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+
+
+class UpdateTraceMiddleware(BaseMiddleware):
+    # Outer update middleware: tags everything done for an update with a
+    # correlation id derived from its update_id.
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: Update, data: Dict[str, Any]) -> Any:
+        UPDATES_TOTAL.inc(type=event.event_type)
+        token = metrics.set_correlation_id(f"tg-{event.update_id}")
+        try:
+            with metrics.span("update", type=event.event_type):
+                return await handler(event, data)
+        finally:
+            metrics.correlation_id.reset(token)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    # Inner middleware: runs only once a handler matched, so the handler's
+    # function name is known.
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        name = data["handler"].callback.__name__
+        try:
+            with metrics.track(HANDLER_SECONDS, handler=name), metrics.span("handler." + name):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+
+
+def instrument_router(router):
+    timing = HandlerTimingMiddleware()
+    router.message.middleware(timing)
+    router.callback_query.middleware(timing)
+
+
+async def serve_metrics(host: str, port: int) -> web.AppRunner:
+    # Standalone /metrics endpoint for polling mode, where the bot has no
+    # HTTP server of its own.
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics.metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
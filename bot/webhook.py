@@ -0,0 +1,165 @@
+import asyncio
+import hmac
+import re
+from collections import deque
+from aiohttp import web
+from aiogram.types import Update
+
+from common import metrics
+
+WEBHOOK_PATH = "/telegram-webhook"
+WEBHOOK_MAX_IN_FLIGHT = 100
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+SECRET_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,256}")
+
+
+def update_chat_id(data: dict):
+    # Chat the raw update belongs to, used to keep each chat's updates in order.
+    for kind, payload in data.items():
+        if not isinstance(payload, dict):
+            continue
+        if kind == "callback_query":
+            chat = (payload.get("message") or {}).get("chat") or payload.get("from") or {}
+        else:
+            chat = payload.get("chat") or payload.get("from") or payload.get("user") or {}
+        if "id" in chat:
+            return chat["id"]
+    return None
+
+
+def check_secret(url: str, secret: str):
+    # Without a secret anyone who finds a public webhook URL can post forged
+    # updates, e.g. with an admin's user id. Telegram only accepts these
+    # characters in secret_token.
+    if secret and not SECRET_PATTERN.fullmatch(secret):
+        raise ValueError("WEBHOOK_SECRET: допустимы только символы A-Z, a-z, 0-9, _ и -, не длиннее 256")
+    if url and not secret:
+        raise ValueError("WEBHOOK_SECRET обязателен, если задан WEBHOOK_URL")
+
+
+def secret_matches(request, secret: str) -> bool:
+    # Compared as bytes: compare_digest rejects non-ASCII str.
+    received = request.headers.get(SECRET_HEADER, "").encode()
+    return hmac.compare_digest(received, secret.encode())
+
+
+class UpdateProcessor:
+    # Runs updates of up to `max_in_flight` chats concurrently. Each chat
+    # has a queue drained by one task, in arrival order, because the FSM
+    # flow depends on it. Only that task holds a slot, so a chat with a
+    # backlog does not keep other chats waiting.
+
+    def __init__(self, dp, bot, max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT):
+        self.dp = dp
+        self.bot = bot
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.queues = {}
+        self.tasks = set()
+        self.processed = 0
+        self.failed = 0
+
+    async def submit(self, data: dict):
+        chat_id = update_chat_id(data)
+        queue = self.queues.get(chat_id) if chat_id is not None else None
+        if queue is not None:
+            queue.append(data)
+            return
+        # Registered before waiting for a slot, so later updates of the chat
+        # line up behind this one.
+        queue = deque([data])
+        if chat_id is not None:
+            self.queues[chat_id] = queue
+        acquired = False
+        try:
+            await self.slots.acquire()
+            acquired = True
+        finally:
+            # Started even if this request was cancelled meanwhile, since
+            # updates queued behind it have already been acknowledged.
+            task = asyncio.create_task(self._run(chat_id, queue, acquired))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, chat_id, queue, acquired: bool):
+        try:
+            while queue:
+                await self._process(queue.popleft())
+        finally:
+            if self.queues.get(chat_id) is queue:
+                del self.queues[chat_id]
+            if acquired:
+                self.slots.release()
+
+    async def _process(self, data: dict):
+        try:
+            update = Update.model_validate(data, context={"bot": self.bot})
+            await self.dp.feed_update(self.bot, update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"Ошибка при обработке обновления {data.get('update_id')}:", str(e))
+
+    async def drain(self):
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "in_flight": len(self.tasks),
+            "queued": sum(len(queue) for queue in self.queues.values()),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+
+async def telegram_webhook(request):
+    secret = request.app["secret"]
+    if secret and not secret_matches(request, secret):
+        return web.Response(status=401)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    await request.app["updates"].submit(data)
+    return web.Response()
+
+
+async def healthz(request):
+    return web.json_response(request.app["updates"].stats())
+
+
+async def on_shutdown(app):
+    await app["updates"].drain()
+
+
+def create_app(dp, bot, secret: str = "", path: str = WEBHOOK_PATH,
+               max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT) -> web.Application:
+    app = web.Application()
+    app["secret"] = secret
+    app["updates"] = UpdateProcessor(dp, bot, max_in_flight)
+    app.router.add_post(path, telegram_webhook)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/metrics", metrics.metrics_handler)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+async def serve(dp, bot, host: str, port: int, url: str = "", secret: str = "",
+                path: str = WEBHOOK_PATH, max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT):
+    # With an empty url the webhook is not registered with Telegram, which is
+    # how the endpoint is tested locally by POSTing recorded updates to it.
+    check_secret(url, secret)
+    runner = web.AppRunner(create_app(dp, bot, secret, path, max_in_flight))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        if url:
+            await bot.set_webhook(
+                url,
+                secret_token=secret or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=False,
+            )
+        print(f"Бот принимает обновления на http://{host}:{port}{path}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
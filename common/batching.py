@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+# Size/time batching shared by the bot's and the listener's write-behind
+# buffers.
+
+
+class WriteBehind:
+    # Collects values by key and hands them to write() as one batch once
+    # flush_size keys are pending or flush_interval seconds have passed since
+    # the first one. A newer value for a pending key replaces the buffered
+    # one. If write() raises, the batch is put back, except for keys that got
+    # a newer value meanwhile, and is retried flush_interval later, also when
+    # it is full. Subclasses implement write(batch, first_at) and set
+    # error_message.
+
+    error_message = "Ошибка при записи пакета:"
+
+    def __init__(self, flush_size: int, flush_interval: float):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.first_at = None
+        self.flushes = 0
+        self.errors = 0
+        self._has_data = None
+        self._full = None
+        self._lock = None
+        self._task = None
+
+    def start(self):
+        self._has_data = asyncio.Event()
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+
+    def add(self, key, value) -> bool:
+        # Returns False when the value replaced one already pending.
+        replaced = key in self.pending
+        if not self.pending:
+            self.first_at = time.monotonic()
+        self.pending[key] = value
+        self._has_data.set()
+        if len(self.pending) >= self.flush_size:
+            self._full.set()
+        return not replaced
+
+    async def _run(self):
+        while True:
+            await self._has_data.wait()
+            timeout = self.first_at + self.flush_interval - time.monotonic()
+            try:
+                await asyncio.wait_for(self._full.wait(), max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            first_at, self.first_at = self.first_at, None
+            self._has_data.clear()
+            self._full.clear()
+            try:
+                await self.write(batch, first_at)
+            except Exception as e:
+                self.errors += 1
+                print(self.error_message, str(e))
+                self.pending = {**batch, **self.pending}
+                self.first_at = self.first_at or time.monotonic()
+                self._has_data.set()
+                return
+            self.flushes += 1
+
+    async def write(self, batch: dict, first_at: float):
+        raise NotImplementedError
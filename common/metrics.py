@@ -0,0 +1,208 @@
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from aiohttp import web
+
+# Small in-process metrics registry shared by the bot and the listener.
+# render() produces the Prometheus text exposition format, served on /metrics.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TRACE_ENABLED = False
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.function is not None:
+            return [f"{self.name} {self.function()}"]
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Re-registering a name returns the existing metric, so modules can be
+        # re-imported (e.g. in spawned worker processes) without errors.
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), function=None) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames, function))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+@contextmanager
+def track(latency: Histogram, in_flight: Gauge = None, **labels):
+    if in_flight is not None:
+        in_flight.inc(**labels)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        latency.observe(time.perf_counter() - started, **labels)
+        if in_flight is not None:
+            in_flight.dec(**labels)
+
+
+def instrument(latency: Histogram, in_flight: Gauge = None, label: str = "function"):
+    # Decorator for coroutine functions; the function name becomes `label`.
+    def decorator(func):
+        labels = {label: func.__name__}
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with track(latency, in_flight, **labels):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+async def metrics_handler(request):
+    # aiohttp's content_type argument takes no parameters, so the version of
+    # the exposition format is set in the header directly.
+    return web.Response(text=REGISTRY.render(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+# -----------------------------
+# TRACING
+# -----------------------------
+
+correlation_id: ContextVar = ContextVar("correlation_id", default=None)
+
+
+def new_correlation_id(prefix: str = "") -> str:
+    return f"{prefix}{uuid.uuid4().hex[:12]}"
+
+
+def set_correlation_id(value):
+    return correlation_id.set(value)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    # Prints one line per finished span when TRACE_ENABLED, tagged with the
+    # correlation id of the Telegram update or Jira webhook being handled.
+    if not TRACE_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        details = " ".join(f"{key}={value}" for key, value in attributes.items())
+        status = f" error={error}" if error else ""
+        print(f"[trace {correlation_id.get() or '-'}] {name} {elapsed:.1f}ms {details}{status}".rstrip())
@@ -0,0 +1,16 @@
+# Jira status names and the labels stored in tasks.state and shown to users.
+
+STATUS_MAP = {
+    "To Do": "📝 К выполнению",
+    "In Progress": "🚧 В работе",
+    "In Review": "🔍 На проверке",
+    "Done": "✅ Готово",
+    "Blocked": "⛔ Заблокирована",
+    "Reopened": "♻️ Переоткрыта",
+    "Closed": "🔒 Закрыта",
+    "Cancelled": "❌ Отменена",
+    "Test": "🧪 На тестировании",
+    "Ready for QA": "📦 Готово к QA",
+    "Deployed": "🚀 Развернута",
+}
+UNKNOWN_STATUS = "📄 Неизвестный статус"
@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+COALESCE_WINDOW = 3.0
+DEDUP_TTL = 600
+DEDUP_MAX_KEYS = 50000
+MESSAGE_LIMIT = 4096
+
+
+class Deduplicator:
+    # Remembers recently seen webhook deliveries for DEDUP_TTL seconds.
+
+    def __init__(self, ttl: float = DEDUP_TTL, max_keys: int = DEDUP_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.seen = OrderedDict()
+        self.duplicates = 0
+
+    def is_duplicate(self, key) -> bool:
+        now = time.monotonic()
+        while self.seen:
+            seen_at = next(iter(self.seen.values()))
+            if now - seen_at < self.ttl and len(self.seen) < self.max_keys:
+                break
+            self.seen.popitem(last=False)
+        if key in self.seen:
+            self.duplicates += 1
+            return True
+        self.seen[key] = now
+        return False
+
+    def forget(self, key):
+        # For deliveries that were not accepted, so the sender's retry is processed.
+        self.seen.pop(key, None)
+
+
+class Digest:
+    __slots__ = ("chat_id", "issue_key", "statuses", "comments")
+
+    def __init__(self, chat_id, issue_key):
+        self.chat_id = chat_id
+        self.issue_key = issue_key
+        self.statuses = []
+        self.comments = []
+
+
+class Coalescer:
+    # Events for the same (chat_id, issue_key) arriving within `window`
+    # seconds of the first one are merged into a single Digest, which is
+    # handed to `flush_handler` when the window closes.
+
+    def __init__(self, flush_handler, window: float = COALESCE_WINDOW):
+        self.flush_handler = flush_handler
+        self.window = window
+        self.pending: dict = {}
+        self.timers: dict = {}
+        self.flushing = set()
+        self.events = 0
+        self.digests = 0
+        self.skipped = 0
+
+    def skip(self):
+        self.skipped += 1
+
+    def add(self, chat_id, issue_key, transition=None, comment=None):
+        key = (chat_id, issue_key)
+        digest = self.pending.get(key)
+        if digest is None:
+            digest = self.pending[key] = Digest(chat_id, issue_key)
+            self.timers[key] = asyncio.get_running_loop().call_later(
+                self.window, self._flush_later, key
+            )
+        if transition is not None:
+            from_status, to_status = transition
+            if not digest.statuses:
+                digest.statuses.append(from_status)
+            digest.statuses.append(to_status)
+        if comment is not None:
+            digest.comments.append(comment)
+        self.events += 1
+
+    def _flush_later(self, key):
+        task = asyncio.create_task(self.flush(key))
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def flush(self, key):
+        digest = self.pending.pop(key, None)
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if digest is None:
+            return
+        self.digests += 1
+        try:
+            await self.flush_handler(digest)
+        except Exception as e:
+            print(f"Ошибка при отправке сводки по {digest.issue_key}:", str(e))
+
+    async def close(self):
+        await asyncio.gather(*(self.flush(key) for key in list(self.pending)), *self.flushing)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "events": self.events,
+            "digests": self.digests,
+            "skipped": self.skipped,
+        }
+
+
+def render_digest(digest: Digest, status_map: dict, unknown_status: str) -> str:
+    parts = []
+    if digest.statuses:
+        readable = " → ".join(status_map.get(status, unknown_status) for status in digest.statuses)
+        parts.append(f"Статус задачи {digest.issue_key} изменился: {readable}")
+    if len(digest.comments) == 1:
+        parts.append(f"К задаче {digest.issue_key} добавлен новый комментарий:\n {digest.comments[0]}")
+    elif digest.comments:
+        bodies = "\n".join(f"— {body}" for body in digest.comments)
+        parts.append(f"К задаче {digest.issue_key} добавлено новых комментариев: {len(digest.comments)}\n{bodies}")
+    text = "\n\n".join(parts)
+    if len(text) > MESSAGE_LIMIT:
+        text = text[:MESSAGE_LIMIT - 1] + "…"
+    return text
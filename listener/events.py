@@ -0,0 +1,57 @@
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    import json
+
+    loads = json.loads
+
+# Jira sends the whole issue with every webhook: all custom fields, user
+# objects, rendered fields. The listener only needs a handful of them, so
+# payloads are reduced to a JiraEvent right after decoding and the full
+# dict is dropped before the event is queued.
+
+
+class JiraEvent:
+    __slots__ = ("webhook_event", "timestamp", "issue_key", "label",
+                 "transition", "comment", "comment_id", "changelog_id")
+
+    def __init__(self, webhook_event, timestamp, issue_key, label, transition, comment, comment_id, changelog_id):
+        self.webhook_event = webhook_event
+        self.timestamp = timestamp
+        self.issue_key = issue_key
+        self.label = label
+        self.transition = transition
+        self.comment = comment
+        self.comment_id = comment_id
+        self.changelog_id = changelog_id
+
+    def delivery_key(self) -> tuple:
+        return (self.webhook_event, self.issue_key, self.timestamp, self.comment_id, self.changelog_id)
+
+
+def parse_event(body: bytes) -> JiraEvent:
+    # Raises ValueError (or KeyError/TypeError) when the body is not a Jira
+    # issue event.
+    data = loads(body)
+    issue = data["issue"]
+    labels = (issue.get("fields") or {}).get("labels") or [None]
+
+    transition = None
+    comment = None
+    comment_id = None
+    changelog = data.get("changelog") or {}
+    if "comment" in data:
+        comment = data["comment"]["body"]
+        comment_id = data["comment"].get("id")
+    elif changelog:
+        for item in changelog.get("items", []):
+            if item.get("field") == "status":
+                transition = (item.get("fromString", "неизвестно"), item.get("toString", "неизвестно"))
+                break
+
+    return JiraEvent(
+        data.get("webhookEvent"), data.get("timestamp"), issue["key"], labels[0],
+        transition, comment, comment_id, changelog.get("id"),
+    )
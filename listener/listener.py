@@ -1,88 +1,238 @@
-from flask import Flask, request
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
 import asyncio
 import aiosqlite
-import requests
-
-app = Flask(__name__)
+import time
+from common import metrics
+from common.statuses import STATUS_MAP, UNKNOWN_STATUS
+from telegram_sender import TelegramSender
+from coalescer import Coalescer, Deduplicator, render_digest
+from status_writer import StatusWriteBehind
+from events import parse_event
 
 TELEGRAM_BOT_TOKEN = ""
 DB_PATH = ""
-STATUS_MAP = {
-    "To Do": "📝 К выполнению",
-    "In Progress": "🚧 В работе",
-    "In Review": "🔍 На проверке",
-    "Done": "✅ Готово",
-    "Blocked": "⛔ Заблокирована",
-    "Reopened": "♻️ Переоткрыта",
-    "Closed": "🔒 Закрыта",
-    "Cancelled": "❌ Отменена",
-    "Test": "🧪 На тестировании",
-    "Ready for QA": "📦 Готово к QA",
-    "Deployed": "🚀 Развернута",
-}
+ARCHIVE_DB_PATH = ""  # the bot's task_storage.ARCHIVE_DB_PATH, if it archives to a separate file
+HOST = "0.0.0.0"
+PORT = 3000
+QUEUE_SIZE = 1000
+WORKERS = 4
+DRAIN_TIMEOUT = 30
+TRACE_ENABLED = False
+MAX_WEBHOOK_SIZE = 1024 * 1024
+
+WEBHOOKS_TOTAL = metrics.counter("listener_webhooks_total", "Jira webhooks received, by outcome.", ("result",))
+EVENT_SECONDS = metrics.histogram("listener_event_seconds", "Time spent processing one Jira event.")
+EVENT_LAG_SECONDS = metrics.histogram("listener_event_lag_seconds", "Time a Jira event waited in the queue.")
+LOOKUP_SECONDS = metrics.histogram("sqlite_query_seconds", "Latency of SQLite lookups.", ("function",))
+
+metrics.TRACE_ENABLED = TRACE_ENABLED
+
+telegram = TelegramSender(TELEGRAM_BOT_TOKEN)
 
 def send_telegram_message(message, chat_id):
-    telegram_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": chat_id,
-        "text": message
-    }
-    response = requests.post(telegram_url, data=payload)
-    if response.status_code == 200:
-        print("Сообщение отправлено в Telegram")
-    else:
-        print("Ошибка при отправке сообщения", response.text)
+    telegram.send(chat_id, message)
+
+status_writer = StatusWriteBehind(DB_PATH, archive_path=ARCHIVE_DB_PATH)
+db = None
 
 async def change_status(task_key, new_status):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE tasks SET state = ? WHERE task_key = ?",
-            (new_status, task_key)
-        )
-        await db.commit()
+    status_writer.put(task_key, new_status)
 
 async def get_chat_id_by_task_key(task_key: str, label_user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
+    # Archived tasks still get notifications, e.g. when an issue is reopened.
+    archive_table = "archive.tasks_archive" if ARCHIVE_DB_PATH else "tasks_archive"
+    with metrics.track(LOOKUP_SECONDS, function="get_chat_id_by_task_key"):
+        async with db.execute(f"""
             SELECT user_id FROM tasks WHERE task_key = ?
-        """, (task_key,))
-        row = await cursor.fetchone()
-        return row[0] if row else label_user_id        
+            UNION ALL
+            SELECT user_id FROM {archive_table} WHERE task_key = ?
+            LIMIT 1
+        """, (task_key, task_key)) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else label_user_id
 
-@app.route('/jira-webhook', methods=['POST'])
-def jira_webhook():
-    data = request.json
-    print('Received event:', data)
+async def deliver_digest(digest):
+    if digest.statuses:
+        await change_status(digest.issue_key, STATUS_MAP.get(digest.statuses[-1], UNKNOWN_STATUS))
+    if digest.chat_id is None:
+        print(f"Не найден получатель уведомления по задаче {digest.issue_key}")
+        return
+    send_telegram_message(render_digest(digest, STATUS_MAP, UNKNOWN_STATUS), digest.chat_id)
 
-    issue_key = data['issue']['key']
-    label = data['issue']['fields'].get('labels', [None])[0]
+coalescer = Coalescer(deliver_digest)
+deduplicator = Deduplicator()
+
+metrics.gauge("listener_telegram_pending", "Messages waiting to be sent to Telegram.",
+              function=lambda: telegram.pending)
+metrics.gauge("listener_status_pending", "Task states waiting in the write-behind buffer.",
+              function=lambda: len(status_writer.pending))
+metrics.gauge("listener_coalescer_pending", "Digests waiting for their window to close.",
+              function=lambda: len(coalescer.pending))
+
+def delivery_id(request, event):
+    # Jira keeps X-Atlassian-Webhook-Identifier across retries of one delivery.
+    identifier = request.headers.get("X-Atlassian-Webhook-Identifier")
+    if identifier:
+        return identifier
+    return event.delivery_key()
+
+async def process_event(event):
+    if event.transition is None and event.comment is None:
+        coalescer.skip()
+        return
+
+    label = event.label
     label_user_id = label.split(":")[1] if label and label.startswith("user_id:") else None
+    chat_id = await get_chat_id_by_task_key(event.issue_key, label_user_id)
+    coalescer.add(chat_id, event.issue_key, event.transition, event.comment)
+
+# -----------------------------
+# EVENT QUEUE
+# -----------------------------
+
+class EventQueue:
+    # Webhooks are acked as soon as they are queued; a pool of worker tasks
+    # drains the queue in the background.
+
+    def __init__(self, handler, maxsize: int = QUEUE_SIZE, workers: int = WORKERS):
+        self.handler = handler
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.workers_count = workers
+        self.workers = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def submit(self, event) -> bool:
+        try:
+            self.queue.put_nowait((time.monotonic(), metrics.correlation_id.get(), event))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.received += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            enqueued_at, correlation_id, event = await self.queue.get()
+            self.last_lag = time.monotonic() - enqueued_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+            EVENT_LAG_SECONDS.observe(self.last_lag)
+            metrics.set_correlation_id(correlation_id)
+            try:
+                with metrics.track(EVENT_SECONDS), metrics.span("jira.event"):
+                    await self.handler(event)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print("Ошибка при обработке события:", str(e))
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Очередь не опустела за {timeout} с, потеряно событий: {self.queue.qsize()}")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+# -----------------------------
+# HTTP SERVER
+# -----------------------------
+
+async def jira_webhook(request):
+    # Bodies without Content-Length are cut off by client_max_size while reading.
+    max_size = request.app["max_webhook_size"]
+    if max_size and request.content_length is not None and request.content_length > max_size:
+        WEBHOOKS_TOTAL.inc(result="too_large")
+        return web.Response(text="Payload too large", status=413)
+    try:
+        event = parse_event(await request.read())
+    except web.HTTPRequestEntityTooLarge:
+        WEBHOOKS_TOTAL.inc(result="too_large")
+        raise
+    except (ValueError, KeyError, TypeError, AttributeError):
+        WEBHOOKS_TOTAL.inc(result="invalid")
+        return web.Response(text="Invalid event", status=400)
+
+    identifier = delivery_id(request, event)
+    if deduplicator.is_duplicate(identifier):
+        WEBHOOKS_TOTAL.inc(result="duplicate")
+        return web.Response(text="OK")
+    metrics.set_correlation_id(identifier if isinstance(identifier, str) else metrics.new_correlation_id("jira-"))
+    if not request.app["events"].submit(event):
+        deduplicator.forget(identifier)
+        WEBHOOKS_TOTAL.inc(result="dropped")
+        return web.Response(text="Queue is full", status=503)
+    WEBHOOKS_TOTAL.inc(result="queued")
+    return web.Response(text="OK")
+
+async def queue_stats(request):
+    return web.json_response(request.app["events"].stats())
 
+async def telegram_stats(request):
+    return web.json_response(telegram.stats())
 
+async def status_writer_stats(request):
+    return web.json_response(status_writer.stats())
 
-    async def get_and_send_message():
-        chat_id = await get_chat_id_by_task_key(issue_key, label_user_id)
-        message = ""
+async def coalescer_stats(request):
+    return web.json_response({**coalescer.stats(), "duplicates": deduplicator.duplicates})
 
-        if 'comment' in data:
-            comments = data['comment']['body']
-            message = f"К задаче {issue_key} добавлен новый комментарий:\n {comments}"   
-        elif 'changelog' in data:
-            for item in data['changelog'].get('items', []):
-                if item.get('field') == 'status':
-                    from_status = item.get('fromString', 'неизвестно')
-                    readable_from_status = STATUS_MAP.get(from_status, "📄 Неизвестный статус")
-                    to_status = item.get('toString', 'неизвестно')
-                    readable_to_status = STATUS_MAP.get(to_status, "📄 Неизвестный статус")
-                    message = f"Статус задачи {issue_key} изменился: {readable_from_status} → {readable_to_status}"
-                    await change_status(issue_key, readable_to_status)
-                    break
+async def on_startup(app):
+    global db
+    db = await aiosqlite.connect(DB_PATH)
+    if ARCHIVE_DB_PATH:
+        await db.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+    await db.execute("PRAGMA query_only = ON;")
+    await status_writer.start()
+    await telegram.start()
+    app["events"].start()
 
-        send_telegram_message(message, chat_id)
-    
-    asyncio.run(get_and_send_message())
+async def on_shutdown(app):
+    await app["events"].stop()
+    await coalescer.close()
+    await telegram.close()
+    await status_writer.close()
+    await db.close()
 
-    return "OK", 200
+def create_app(max_webhook_size: int = MAX_WEBHOOK_SIZE):
+    app = web.Application(client_max_size=max_webhook_size or 2 ** 63)
+    app["max_webhook_size"] = max_webhook_size
+    app["events"] = EventQueue(process_event)
+    app.router.add_post('/jira-webhook', jira_webhook)
+    app.router.add_get('/queue-stats', queue_stats)
+    app.router.add_get('/telegram-stats', telegram_stats)
+    app.router.add_get('/coalescer-stats', coalescer_stats)
+    app.router.add_get('/status-writer-stats', status_writer_stats)
+    app.router.add_get('/metrics', metrics.metrics_handler)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=3000)
+    web.run_app(create_app(), host=HOST, port=PORT)
@@ -0,0 +1,92 @@
+import aiosqlite
+import time
+from common import metrics
+from common.batching import WriteBehind
+
+FLUSH_SIZE = 200
+FLUSH_INTERVAL = 1.0
+
+FLUSH_SECONDS = metrics.histogram("listener_status_flush_seconds", "Latency of one status write-behind flush.")
+ROWS_WRITTEN = metrics.counter("listener_status_rows_written_total", "Task states written by the write-behind buffer.")
+
+
+class StatusWriteBehind(WriteBehind):
+    # Buffers task state changes and writes them in one transaction once
+    # FLUSH_SIZE keys are pending or FLUSH_INTERVAL seconds have passed since
+    # the first one. A newer state for the same task_key replaces the
+    # buffered one. A task the bot has archived is moved back to `tasks`
+    # with its new state, e.g. when the issue is reopened; the bot archives
+    # it again once it is finished and old enough.
+
+    error_message = "Ошибка при сохранении статусов задач:"
+
+    def __init__(self, db_path: str, flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 archive_path: str = ""):
+        super().__init__(flush_size, flush_interval)
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.db = None
+        self.updates = 0
+        self.replaced = 0
+        self.rows_written = 0
+        self.last_flush_size = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.max_buffer_age = 0.0
+
+    async def start(self):
+        self.db = await aiosqlite.connect(self.db_path)
+        await self.db.execute("PRAGMA busy_timeout = 5000;")
+        if self.archive_path:
+            await self.db.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        super().start()
+
+    async def close(self):
+        await super().close()
+        await self.db.close()
+
+    def put(self, task_key: str, state: str):
+        if not self.add(task_key, state):
+            self.replaced += 1
+        self.updates += 1
+
+    async def write(self, batch: dict, first_at: float):
+        started = time.monotonic()
+        try:
+            rows = [(state, task_key) for task_key, state in batch.items()]
+            await self.db.executemany("UPDATE tasks SET state = ? WHERE task_key = ?", rows)
+            archive = "archive.tasks_archive" if self.archive_path else "tasks_archive"
+            await self.db.executemany(f"""
+                INSERT OR IGNORE INTO tasks (id, user_id, task_key, summary, state, created_at)
+                SELECT id, user_id, task_key, summary, ?, created_at FROM {archive} WHERE task_key = ?
+            """, rows)
+            await self.db.executemany(
+                f"DELETE FROM {archive} WHERE task_key = ?", [(task_key,) for task_key in batch]
+            )
+            await self.db.commit()
+        except BaseException:
+            await self.db.rollback()
+            raise
+        now = time.monotonic()
+        FLUSH_SECONDS.observe(now - started)
+        ROWS_WRITTEN.inc(len(batch))
+        self.rows_written += len(batch)
+        self.last_flush_size = len(batch)
+        self.last_flush_latency = now - started
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.max_buffer_age = max(self.max_buffer_age, now - first_at)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "updates": self.updates,
+            "replaced": self.replaced,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+            "last_flush_size": self.last_flush_size,
+            "avg_flush_size": self.rows_written / self.flushes if self.flushes else 0.0,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+            "max_buffer_age": self.max_buffer_age,
+        }
@@ -0,0 +1,219 @@
+import aiohttp
+import asyncio
+import random
+import time
+from collections import deque
+from common import metrics
+
+GLOBAL_RATE = 25
+GLOBAL_BURST = 25
+PER_CHAT_INTERVAL = 1.0
+MAX_CONCURRENT_SENDS = 16
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+DRAIN_TIMEOUT = 30
+
+SEND_SECONDS = metrics.histogram("listener_telegram_send_seconds", "Latency of sendMessage calls.")
+SEND_RESULTS = metrics.counter("listener_telegram_sends_total", "sendMessage calls by outcome.", ("result",))
+SEND_IN_FLIGHT = metrics.gauge("listener_telegram_sends_in_flight", "sendMessage calls awaiting a response.")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OutgoingMessage:
+    __slots__ = ("chat_id", "text", "attempts", "correlation_id")
+
+    def __init__(self, chat_id, text):
+        self.chat_id = chat_id
+        self.text = text
+        self.attempts = 0
+        self.correlation_id = metrics.correlation_id.get()
+
+
+class TelegramSender:
+    # Messages are queued per chat. The scheduler walks the chats round-robin,
+    # so one busy chat cannot starve the others, and takes a token from the
+    # global bucket before every send. A chat is not sent to again until
+    # PER_CHAT_INTERVAL has passed, or until its retry_after has expired.
+
+    def __init__(self, token: str, rate: float = GLOBAL_RATE, burst: float = GLOBAL_BURST,
+                 per_chat_interval: float = PER_CHAT_INTERVAL,
+                 max_concurrent: int = MAX_CONCURRENT_SENDS):
+        self.url = f"https://api.telegram.org/bot{token}/sendMessage"
+        self.bucket = TokenBucket(rate, burst)
+        self.per_chat_interval = per_chat_interval
+        self.max_concurrent = max_concurrent
+        self.session: aiohttp.ClientSession | None = None
+        self.chats: dict = {}
+        self.ready_at: dict = {}
+        self.rotation = deque()
+        self.pending = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttled = 0
+        self.started_at = time.monotonic()
+        self._slots = None
+        self._wakeup = None
+        self._idle = None
+        self._scheduler = None
+        self.delivering = set()
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrent, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.started_at = time.monotonic()
+        self._scheduler = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = DRAIN_TIMEOUT):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Не отправлено сообщений в Telegram: {self.pending}")
+        self._scheduler.cancel()
+        for task in self.delivering:
+            task.cancel()
+        await asyncio.gather(self._scheduler, *self.delivering, return_exceptions=True)
+        await self.session.close()
+
+    def send(self, chat_id, text: str):
+        self._enqueue(OutgoingMessage(chat_id, text))
+
+    def _enqueue(self, message: OutgoingMessage, delay: float = 0.0, front: bool = False):
+        queue = self.chats.get(message.chat_id)
+        if queue is None:
+            queue = self.chats[message.chat_id] = deque()
+        if front:
+            queue.appendleft(message)
+        else:
+            queue.append(message)
+        if delay:
+            self.ready_at[message.chat_id] = max(self.ready_at.get(message.chat_id, 0), time.monotonic() + delay)
+        if len(queue) == 1:
+            self.rotation.append(message.chat_id)
+        self.pending += 1
+        self._idle.clear()
+        self._wakeup.set()
+
+    async def _next_chat(self):
+        while True:
+            now = time.monotonic()
+            for _ in range(len(self.rotation)):
+                chat_id = self.rotation.popleft()
+                if self.ready_at.get(chat_id, 0) <= now:
+                    return chat_id
+                self.rotation.append(chat_id)
+            timeout = None
+            if self.rotation:
+                timeout = min(self.ready_at[chat_id] for chat_id in self.rotation) - now
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self):
+        while True:
+            chat_id = await self._next_chat()
+            await self.bucket.take()
+            await self._slots.acquire()
+            queue = self.chats[chat_id]
+            message = queue.popleft()
+            if queue:
+                self.rotation.append(chat_id)
+            else:
+                del self.chats[chat_id]
+            now = time.monotonic()
+            self.ready_at[chat_id] = now + self.per_chat_interval
+            if len(self.ready_at) > 10000:
+                self.ready_at = {
+                    key: ready for key, ready in self.ready_at.items() if ready > now or key in self.chats
+                }
+            self.in_flight += 1
+            task = asyncio.create_task(self._deliver(message))
+            self.delivering.add(task)
+            task.add_done_callback(self.delivering.discard)
+
+    def _backoff(self, attempts: int) -> float:
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempts))
+
+    async def _deliver(self, message: OutgoingMessage):
+        retry_delay = None
+        result = "error"
+        metrics.set_correlation_id(message.correlation_id)
+        try:
+            payload = {"chat_id": message.chat_id, "text": message.text}
+            with metrics.track(SEND_SECONDS, SEND_IN_FLIGHT), \
+                    metrics.span("telegram.sendMessage", chat_id=message.chat_id, attempt=message.attempts):
+                async with self.session.post(self.url, json=payload) as response:
+                    result = str(response.status)
+                    if response.status == 200:
+                        self.sent += 1
+                        return
+                    body = await response.json(content_type=None)
+            if response.status == 429:
+                self.throttled += 1
+                # Proxies answer 429 with HTML or an empty body.
+                parameters = body.get("parameters") if isinstance(body, dict) else None
+                retry_after = parameters.get("retry_after", 1) if isinstance(parameters, dict) else 1
+                retry_delay = retry_after + random.uniform(0, max(0.5, retry_after * 0.1))
+            elif response.status >= 500:
+                retry_delay = self._backoff(message.attempts)
+            else:
+                self.failed += 1
+                print("Ошибка при отправке сообщения", response.status, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print("Ошибка при отправке сообщения", str(e))
+            retry_delay = self._backoff(message.attempts)
+        finally:
+            SEND_RESULTS.inc(result=result)
+            self.in_flight -= 1
+            self.pending -= 1
+            self._slots.release()
+            if retry_delay is not None:
+                message.attempts += 1
+                if message.attempts > MAX_RETRIES:
+                    self.failed += 1
+                    print(f"Сообщение в чат {message.chat_id} не доставлено после {MAX_RETRIES} повторов")
+                else:
+                    self.retries += 1
+                    self._enqueue(message, delay=retry_delay, front=True)
+            if self.pending == 0:
+                self._idle.set()
+
+    def stats(self):
+        uptime = time.monotonic() - self.started_at
+        return {
+            "pending": self.pending,
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "chats_waiting": len(self.chats),
+            "sent_per_second": self.sent / uptime if uptime else 0.0,
+        }